@@ -4,8 +4,14 @@
 import os
 import sys
 import struct
+import time
 import lzma
-from custlzma.frenchlzma import DecodeurLZMASPD # (for LZMA_SPD decompression)
+import mmap
+import bisect
+import shutil
+import tempfile
+from collections import deque
+from contextlib import contextmanager
 
 # common utils
 
@@ -35,15 +41,12 @@ def getCompType(data):
         return CMP_NONE
 
 def getTblOffset(blocksOffTbl, index):
-    tind = index << 2
-    return struct.unpack('<L', blocksOffTbl[tind:tind+4])[0]
+    return struct.unpack_from('<L', blocksOffTbl, index << 2)[0]
 
-def unpack_block(blkData, blkPacSize, targetFile):
-    print('Extracting %s...' % targetFile)
+def block_chunks(blkData): # compression type and offsets of every LZMA block in a COLB payload
     blocksOffTbl = None
     compData = blkData
-    npacHdr = blkData[:16]
-    (npacHdrMagic, npacHdrFlags, compDataSize, lzmaBlocksAmount) = struct.unpack('<LLLL', npacHdr)
+    (npacHdrMagic, npacHdrFlags, compDataSize, lzmaBlocksAmount) = struct.unpack_from('<LLLL', blkData)
     # npacHdrMagic must be CAPN if using offsets
     if npacHdrMagic == 0x4E504143:
         blocksOffTbl = blkData[compDataSize:]
@@ -52,96 +55,559 @@ def unpack_block(blkData, blkPacSize, targetFile):
         lzmaBlocksAmount = 1
     cType = getCompType(compData)
     assert cType == CMP_LZMA or cType == CMP_LZMA_SPRD, 'Only LZMA compression type is implemented as of now'
-    print('Found LZMA blocks: %d, decompressing...' % lzmaBlocksAmount)
-    dest = b''
-    inSizePure = blkPacSize * 2
-    lzmaDec = DecodeurLZMASPD()
+    offsets = []
     for i in range(lzmaBlocksAmount):
         if blocksOffTbl is not None:
-            dataOffset = getTblOffset(blocksOffTbl,i)
-        else:
-            dataOffset = 0
-        compData = blkData[dataOffset:]
-        lzData = compData[0:inSizePure]
-        if cType == CMP_LZMA_SPRD:
-            outdata = lzmaDec.decode(lzData)
-            dest += outdata
+            offsets.append(getTblOffset(blocksOffTbl,i))
         else:
-            dest += lzma.decompress(lzData, format=lzma.FORMAT_ALONE)
-        sys.stdout.write('.')
-        sys.stdout.flush()
-    writeFile(targetFile, dest)
-    print('\n%s decompressed!' % targetFile)
+            offsets.append(0)
+    return cType, offsets
+
+def block_windows(blkData, blkPacSize):
+    # compression type and compressed input windows of every LZMA block in a COLB payload
+    cType, offsets = block_chunks(blkData)
+    print('Found LZMA blocks: %d' % len(offsets))
+    inSizePure = blkPacSize * 2
+    # a window ends where the next stream starts, so it only holds the bytes of its own stream when they're back to back
+    starts = sorted(set(offsets))
+    windows = []
+    for dataOffset in offsets:
+        i = bisect.bisect_right(starts, dataOffset)
+        dataEnd = dataOffset + inSizePure
+        if i < len(starts):
+            dataEnd = min(dataEnd, starts[i])
+        windows.append(blkData[dataOffset:dataEnd])
+    return cType, windows
+
+def lzma_unpacked_size(cType, lzData): # from the LZMA header, None if the stream only has an end marker (or the type doesn't tell)
+    if cType != CMP_LZMA:
+        return None
+    size = struct.unpack_from('<Q', lzData, 5)[0]
+    return None if size == 0xffffffffffffffff else size
+
+spdDecoder = None # LZMA_SPD decoder of this process
+streamChunk = 0x10000 # compressed input fed and decompressed output taken per step when streaming
+poolAhead = 16 # LZMA blocks handed to the pool ahead of the one being written, bounds memory with --jobs
+
+def decompress_block(cType, lzData):
+    global spdDecoder
+    if cType == CMP_LZMA_SPRD:
+        if spdDecoder is None:
+            from custlzma.frenchlzma import DecodeurLZMASPD # only needed for LZMA_SPD images
+            spdDecoder = DecodeurLZMASPD()
+        return spdDecoder.decode(bytes(lzData))
+    # the stream ends at its end marker, whatever follows in the window (padding, next streams) is not part of it
+    dec = lzma.LZMADecompressor(format=lzma.FORMAT_ALONE)
+    data = dec.decompress(lzData)
+    if not dec.eof:
+        raise lzma.LZMAError('Compressed data ended before the end-of-stream marker was reached')
+    return data
 
-def unpack_section(sectionData, targetDir):
-    bzpFileHdr = sectionData[:16]
-    (bzpFileHdrMagic, bzpType, blocksOffset, blocksAmount) = struct.unpack('<LLLL', bzpFileHdr)
+def decompress_job(job): # process pool entry point
+    return decompress_block(*job)
+
+def stream_block(cType, lzData, *outFiles):
+    # decompress straight into the output files, so memory use doesn't depend on the block size
+    if cType == CMP_LZMA_SPRD: # the LZMA_SPD decoder only takes whole blocks
+        data = decompress_block(cType, lzData)
+        for outf in outFiles:
+            outf.write(data)
+        return
+    dec = lzma.LZMADecompressor(format=lzma.FORMAT_ALONE)
+    pos = 0
+    while not dec.eof:
+        chunk = b''
+        if dec.needs_input:
+            if pos >= len(lzData):
+                raise lzma.LZMAError('Compressed data ended before the end-of-stream marker was reached')
+            chunk = lzData[pos:pos+streamChunk]
+            pos += len(chunk)
+        data = dec.decompress(chunk, max_length=streamChunk)
+        for outf in outFiles:
+            outf.write(data)
+
+def ordered_results(pool, func, jobs, ahead): # results of func for every job in order, with at most ahead jobs in flight
+    pending = deque()
+    for job in jobs:
+        pending.append(pool.apply_async(func, (job,)))
+        if len(pending) >= ahead:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
+
+def write_blocks(blocks, pool = None, cache = None):
+    # decompress (block data view, blkPacSize, target file) COLB payloads into their files in order
+    # without a pool every LZMA block is streamed to disk, with one the next blocks are decompressed in parallel
+    # with a BlockCache, files and LZMA blocks seen before come from the cache and only the rest is decompressed
+    files = []
+    for blkData, blkPacSize, targetFile in blocks:
+        cType, windows = block_windows(blkData, blkPacSize)
+        keys = [None] * len(windows)
+        fileKey = None
+        whole = False
+        cached = [False] * len(windows)
+        if cache is not None:
+            keys = [cache.key(cType, w) for w in windows]
+            fileKey = cache.file_key(keys)
+            whole = cache.has(fileKey, 'file')
+            cached = [not whole and cache.has(key) for key in keys]
+        files.append((targetFile, cType, windows, keys, fileKey, whole, cached))
+    if pool is not None:
+        misses = ((cType, bytes(w)) for targetFile, cType, windows, keys, fileKey, whole, cached in files if not whole
+            for w, hit in zip(windows, cached) if not hit)
+        results = ordered_results(pool, decompress_job, misses, poolAhead)
+    for targetFile, cType, windows, keys, fileKey, whole, cached in files:
+        print('Extracting %s...' % targetFile)
+        if whole:
+            cache.copy_file(fileKey, targetFile)
+            print('%s copied from cache!' % targetFile)
+            continue
+        with open(targetFile, 'wb') as outf:
+            for w, key, hit in zip(windows, keys, cached):
+                if hit:
+                    cache.read_block(key, outf)
+                elif pool is not None:
+                    data = next(results)
+                    outf.write(data)
+                    if cache is not None:
+                        cache.put_block(key, data)
+                elif cache is not None:
+                    entry = cache.new_entry(key)
+                    try:
+                        stream_block(cType, w, outf, entry)
+                    except BaseException:
+                        cache.discard(entry)
+                        raise
+                    cache.commit(entry, key)
+                else:
+                    stream_block(cType, w, outf)
+                sys.stdout.write('.')
+                sys.stdout.flush()
+        print('\n%s decompressed!' % targetFile)
+        if cache is not None:
+            cache.add_file(fileKey, targetFile)
+
+def unpack_block(blkData, blkPacSize, targetFile, pool = None, cache = None): # blkData is a view from the block start to the end of the image
+    write_blocks([(blkData, blkPacSize, targetFile)], pool, cache)
+
+def block_file_name(blkId):
+    if blkId == 0x494D4147: # GAMI -> kernel image
+        return 'kern.bin'
+    elif blkId == 0x75736572: # resu -> user image
+        return 'user.bin'
+    elif blkId == 0x7253736F: # resources
+        return 'rsrc.bin'
+    else:
+        return 'blk_%X.bin' % blkId
+
+def block_headers(sectionData): # (blkId, blkDataOffset, blkPackedSize, blkPacSize) of every block in a section
+    (bzpFileHdrMagic, bzpType, blocksOffset, blocksAmount) = struct.unpack_from('<LLLL', sectionData)
     # bzpFileHdrMagic must be DRPS or RRPS
     assert bzpFileHdrMagic == 0x53505244 or bzpFileHdrMagic == 0x53505252, 'Invalid BZP header: 0x%X' % bzpFileHdrMagic
-    bzpSize = blocksOffset + blocksAmount * 20
+    headers = []
     for i in range(blocksAmount):
         blkHdrStart = blocksOffset + i*20
-        blkHdr = sectionData[blkHdrStart:blkHdrStart+20]
-        (blkHdrMagic, blkId, blkDataOffset, blkPackedSize, blkPacSize) = struct.unpack('<LLLLL', blkHdr)
+        (blkHdrMagic, blkId, blkDataOffset, blkPackedSize, blkPacSize) = struct.unpack_from('<LLLLL', sectionData, blkHdrStart)
         # blkHdrMagic must be COLB
         assert blkHdrMagic == 0x424C4F43, 'Invalid BZP block header: 0x%X' % blkHdrMagic
-        if bzpSize < blkDataOffset + blkPackedSize:
-            bzpSize = blkDataOffset + blkPackedSize
-        if blkId == 0x494D4147: # GAMI -> kernel image
-            targetFile = targetDir + '/kern.bin'
-        elif blkId == 0x75736572: # resu -> user image
-            targetFile = targetDir + '/user.bin'
-        elif blkId == 0x7253736F: # resources
-            targetFile = targetDir + '/rsrc.bin'
-        else:
-            targetFile = targetDir + ('/blk_%X.bin' % blkId)
-        unpack_block(sectionData[blkDataOffset:], blkPacSize, targetFile)
+        headers.append((blkId, blkDataOffset, blkPackedSize, blkPacSize))
+    return headers
+
+def section_blocks(sectionData, targetDir): # (block data view, blkPacSize, target file) of every block in a section
+    return [(sectionData[blkDataOffset:], blkPacSize, targetDir + '/' + block_file_name(blkId))
+        for blkId, blkDataOffset, blkPackedSize, blkPacSize in block_headers(sectionData)]
+
+def unpack_section(sectionData, targetDir, pool = None, cache = None): # sectionData is a view from the section start to the end of the image
+    write_blocks(section_blocks(sectionData, targetDir), pool, cache)
+
+# decompressed block cache
+
+def default_cache_dir():
+    return os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'), 'uniflash', 'stoned')
+
+class BlockCache:
+    # decompressed LZMA blocks and whole unpacked files on disk, keyed by a hash of the compressed data and its type
+    # unpacked files are private copies of the entries, so editing them never touches the cache
+    # the least recently used entries are evicted once the cache grows over maxSize bytes
+    def __init__(self, cacheDir = None, maxSize = 512 << 20):
+        import hashlib # only needed with the cache
+        self.sha1 = hashlib.sha1
+        self.dir = cacheDir or default_cache_dir()
+        os.makedirs(self.dir, exist_ok=True)
+        self.maxSize = maxSize
+        self.stats = {'hits': 0, 'misses': 0, 'fileHits': 0, 'bytes': 0, 'evicted': 0}
+
+    def key(self, cType, lzData):
+        h = self.sha1(bytes([cType]))
+        h.update(lzData)
+        return h.hexdigest()
+
+    def file_key(self, keys): # an unpacked file is the LZMA blocks it's made of
+        return self.sha1(''.join(keys).encode()).hexdigest()
+
+    def path(self, key, kind = 'blk'):
+        return os.path.join(self.dir, '%s-%s.bin' % (kind, key))
+
+    def has(self, key, kind = 'blk'):
+        return os.path.exists(self.path(key, kind))
+
+    def used(self, path): # entries are ordered by mtime for eviction
+        os.utime(path)
+        self.stats['bytes'] += os.path.getsize(path)
+
+    def read_block(self, key, outf):
+        path = self.path(key)
+        with open(path, 'rb') as f:
+            shutil.copyfileobj(f, outf)
+        self.used(path)
+        self.stats['hits'] += 1
+
+    def new_entry(self, key, kind = 'blk'): # entries are written under a temporary name of their own and show up on commit()
+        return tempfile.NamedTemporaryFile(dir=self.dir, prefix=os.path.basename(self.path(key, kind)) + '.', suffix='.tmp', delete=False)
+
+    def commit(self, entry, key):
+        entry.close()
+        os.chmod(entry.name, 0o444)
+        os.replace(entry.name, self.path(key))
+        self.stats['misses'] += 1
+
+    def discard(self, entry):
+        entry.close()
+        os.unlink(entry.name)
+
+    def put_block(self, key, data):
+        entry = self.new_entry(key)
+        entry.write(data)
+        self.commit(entry, key)
+
+    def copy_file(self, key, targetFile):
+        path = self.path(key, 'file')
+        shutil.copyfile(path, targetFile)
+        self.used(path)
+        self.stats['fileHits'] += 1
+
+    def add_file(self, key, targetFile):
+        entry = self.new_entry(key, 'file')
+        with open(targetFile, 'rb') as f:
+            shutil.copyfileobj(f, entry)
+        entry.close()
+        os.chmod(entry.name, 0o444)
+        os.replace(entry.name, self.path(key, 'file'))
 
-def unpack_stone(fname, targetDir):
-    fdata = readFile(fname)
-    flen = len(fdata)
+    def evict(self):
+        entries = []
+        for name in os.listdir(self.dir):
+            if name.endswith('.bin'):
+                st = os.stat(os.path.join(self.dir, name))
+                entries.append((st.st_mtime, st.st_size, name))
+        total = sum(size for mtime, size, name in entries)
+        for mtime, size, name in sorted(entries):
+            if total <= self.maxSize:
+                break
+            os.unlink(os.path.join(self.dir, name))
+            total -= size
+            self.stats['evicted'] += 1
+
+    def summary(self):
+        return 'Block cache: %(hits)d hits, %(misses)d misses, %(fileHits)d files copied, %(bytes)d bytes from cache, %(evicted)d entries evicted' % self.stats
+
+@contextmanager
+def mapped_image(fname):
+    # the image is mapped, sections and blocks are views into it, so nothing is copied before decompression
+    flen = os.path.getsize(fname)
     assert flen >= 0x10, 'Input file %s is too small' % fname
+    with open(fname, 'rb') as f:
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        yield mm
+    finally:
+        try:
+            mm.close()
+        except BufferError: # a view is still alive (e.g. in a traceback), the mapping goes away with it
+            pass
+
+def unpack_stone(fname, targetDir, jobs = 1, cache = None):
+    # jobs > 1 decompresses the LZMA blocks of all sections in that many processes
+    # cache is an optional BlockCache to take repeated blocks from
+    with mapped_image(fname) as mm:
+        pool = None
+        if jobs > 1:
+            import multiprocessing
+            pool = multiprocessing.Pool(jobs)
+        try:
+            unpack_image(mm, fname, targetDir, pool, cache)
+        finally:
+            if pool is not None:
+                pool.terminate()
+    if cache is not None:
+        cache.evict()
+        print(cache.summary())
+
+def unpack_image(mm, fname, targetDir, pool = None, cache = None):
+    fdata = memoryview(mm)
 
     # check for security header
     sectionOffset = 0
-    if fdata[0:15] == b'SPRD-SECUREFLAG':
+    if mm[0:15] == b'SPRD-SECUREFLAG':
         sectionOffset = 1024
         print('Signed image detected, using section offset %d' % sectionOffset)
 
     # look for TRAPGAMI header
-    startPos = -1
-    for i in range(flen):
-        if fdata[i:i+8] == b'TRAPGAMI':
-            startPos = i
-            break
+    startPos = mm.find(b'TRAPGAMI')
     assert startPos > 0, 'No stone header found in %s' % fname
     print('Stone header found at 0x%X' % startPos)
 
     psImageEnd = 0xffffffff # PS (protocol station) image is the first in the flash backup and not compressed
 
-    dfcStruct = fdata[startPos+8:startPos+120]
-    for i in range(0,112,4):
-        targetAddr = struct.unpack('<L', dfcStruct[i:i+4])[0]
+    dfcStruct = struct.unpack_from('<28L', mm, startPos+8)
+    blocks = []
+    for targetAddr in dfcStruct:
         if targetAddr < 0xffffffff:
             if targetAddr < psImageEnd:
                 psImageEnd = targetAddr
             print('Target section address found: 0x%X' % targetAddr)
-            unpack_section(fdata[sectionOffset+targetAddr:], targetDir)
-            print('Section 0x%X unpacked!' % targetAddr)
+            blocks += section_blocks(fdata[sectionOffset+targetAddr:], targetDir)
+
+    # blocks of all sections go through the pool as one ordered stream, so sections overlap too
+    write_blocks(blocks, pool, cache)
+    del blocks
 
     if psImageEnd > 0:
         psPath = targetDir + '/ps.bin'
         writeFile(psPath, fdata[:psImageEnd])
         print('Protocol station image %s written!' % psPath)
+    fdata.release()
+
+    # the index keeps what the unpacked files don't tell (section types, block compression) for pack_stone
+    import json
+    writeFile(targetDir + '/' + indexName, json.dumps(image_index(mm, fname), indent=1).encode())
+
+# index and random access part
+
+compNames = {CMP_LZMA: 'lzma', CMP_LZMA_SPRD: 'lzma_spd'}
+compTypes = {name: cType for cType, name in compNames.items()}
+
+def stone_index(fname):
+    # sections, blocks and LZMA block offsets of a stone image from its headers alone, nothing is decompressed
+    # file offsets are absolute, unpacked sizes are None where the LZMA headers don't record them
+    with mapped_image(fname) as mm:
+        return image_index(mm, fname)
+
+def image_index(mm, fname):
+    sectionOffset = 0
+    if mm[0:15] == b'SPRD-SECUREFLAG':
+        sectionOffset = 1024
+    startPos = mm.find(b'TRAPGAMI')
+    assert startPos > 0, 'No stone header found in %s' % fname
+    addrs = [addr for addr in struct.unpack_from('<28L', mm, startPos+8) if addr < 0xffffffff]
+    fdata = memoryview(mm)
+    sections = []
+    for addr in addrs:
+        secStart = sectionOffset + addr
+        blocks = []
+        for blkId, blkDataOffset, blkPackedSize, blkPacSize in block_headers(fdata[secStart:]):
+            blkStart = secStart + blkDataOffset
+            cType, offsets = block_chunks(fdata[blkStart:])
+            chunks = [{'offset': blkStart + o, 'unpackedSize': lzma_unpacked_size(cType, fdata[blkStart+o:])} for o in offsets]
+            sizes = [c['unpackedSize'] for c in chunks]
+            blocks.append({'id': blkId, 'name': block_file_name(blkId), 'offset': blkStart, 'packedSize': blkPackedSize, 'pacSize': blkPacSize,
+                'compression': compNames[cType], 'unpackedSize': None if None in sizes else sum(sizes), 'chunks': chunks})
+        sections.append({'address': addr, 'offset': secStart, 'magic': bytes(mm[secStart:secStart+4]).decode('latin-1'),
+            'type': struct.unpack_from('<L', mm, secStart+4)[0], 'blocks': blocks})
+    fdata.release()
+    return {'file': fname, 'size': len(mm), 'signed': sectionOffset > 0, 'headerOffset': startPos,
+        'psSize': min(addrs) if addrs else None, 'sections': sections}
+
+def find_block(index, block): # block is a block id or its file name like rsrc.bin (or just rsrc)
+    for section in index['sections']:
+        for blk in section['blocks']:
+            if isinstance(block, str):
+                match = blk['name'] in (block, block + '.bin')
+            else:
+                match = blk['id'] == block
+            if match:
+                return blk
+    assert False, 'No block %s in %s' % (block, index['file'])
+
+def block_range(mm, blk, start = 0, length = None):
+    # bytes start..start+length of an indexed block, only the LZMA blocks covering them are decompressed
+    chunks = blk['chunks']
+    cType = compTypes[blk['compression']]
+    window = blk['pacSize'] * 2
+    def chunk_data(i):
+        offset = chunks[i]['offset']
+        return decompress_block(cType, mm[offset:offset+window])
+    sizes = [c['unpackedSize'] for c in chunks]
+    first = None
+    if None in sizes[:-1]:
+        # streams with just an end marker don't tell their size, CAPN splits the data evenly so the first one tells for all
+        first = chunk_data(0)
+        sizes = [len(first)] * (len(chunks) - 1) + sizes[-1:]
+    end = None if length is None else start + length
+    out = bytearray()
+    pos = 0
+    for i, size in enumerate(sizes):
+        if end is not None and pos >= end:
+            break
+        if size is not None and pos + size <= start:
+            pos += size
+            continue
+        data = first if i == 0 and first is not None else chunk_data(i)
+        out += data[max(start - pos, 0):None if end is None else end - pos]
+        pos += len(data)
+    return bytes(out)
+
+def extract_block(fname, block, start = 0, length = None):
+    # bytes start..start+length (to the end if length is None) of the unpacked block given by id or file name
+    with mapped_image(fname) as mm:
+        blk = find_block(image_index(mm, fname), block)
+        return block_range(mm, blk, start, length)
+
+# pack part
+
+# BZP sections of a packed image in order: (magic, [(block id, file name)]), blk_*.bin files go with kern/user
+packLayout = [
+    (0x53505244, [(0x494D4147, 'kern.bin'), (0x75736572, 'user.bin')]), # DRPS
+    (0x53505252, [(0x7253736F, 'rsrc.bin')]) # RRPS
+]
+
+indexName = 'stone.json' # index of the unpacked image, written next to the files
+
+def compress_job(data): # process pool entry point
+    # the dictionary is no bigger than the chunk, so the decoder on the device gets by with little RAM
+    filters = [{'id': lzma.FILTER_LZMA1, 'preset': 6, 'dict_size': max(len(data), 4096)}]
+    return lzma.compress(data, format=lzma.FORMAT_ALONE, filters=filters)
+
+def file_chunks(fname, chunkSize): # at least one chunk, even for an empty file
+    with open(fname, 'rb') as f:
+        chunk = f.read(chunkSize)
+        while True:
+            yield chunk
+            chunk = f.read(chunkSize)
+            if not chunk:
+                return
+
+def pack_block(outf, srcFile, chunkSize, pool = None):
+    # write the CAPN payload of srcFile at the current position of outf, returns (packed size, blkPacSize)
+    # LZMA streams follow the header back to back, the offset table comes after them
+    start = outf.tell()
+    outf.write(bytes(16)) # CAPN header, filled in once the streams are written
+    chunks = file_chunks(srcFile, chunkSize)
+    if pool is not None:
+        streams = ordered_results(pool, compress_job, chunks, poolAhead)
+    else:
+        streams = map(compress_job, chunks)
+    offsets = []
+    maxStream = 0
+    for lzData in streams:
+        offsets.append(outf.tell() - start)
+        outf.write(lzData)
+        maxStream = max(maxStream, len(lzData))
+        sys.stdout.write('.')
+        sys.stdout.flush()
+    compDataSize = outf.tell() - start
+    outf.write(struct.pack('<%dL' % len(offsets), *offsets))
+    end = outf.tell()
+    outf.seek(start)
+    outf.write(struct.pack('<LLLL', 0x4E504143, 0, compDataSize, len(offsets)))
+    outf.seek(end)
+    return end - start, (maxStream + 1) // 2 # unpack_block reads 2 * blkPacSize from every stream offset
+
+def pack_section(outf, magic, blocks, chunkSize, pool = None, secType = 0):
+    # write a BZP section of (block id, source file) blocks at the current position of outf
+    start = outf.tell()
+    outf.write(struct.pack('<LLLL', magic, secType, 16, len(blocks)))
+    outf.write(bytes(20 * len(blocks))) # COLB headers, filled in after every block
+    for i, (blkId, srcFile) in enumerate(blocks):
+        print('Compressing %s...' % srcFile)
+        blkDataOffset = outf.tell() - start
+        blkPackedSize, blkPacSize = pack_block(outf, srcFile, chunkSize, pool)
+        end = outf.tell()
+        outf.seek(start + 16 + i*20)
+        outf.write(struct.pack('<LLLLL', 0x424C4F43, blkId, blkDataOffset, blkPackedSize, blkPacSize))
+        outf.seek(end)
+        print('\n%s compressed!' % srcFile)
+
+def pack_stone(srcDir, fname, jobs = 1, chunkSize = 0x10000):
+    # rebuild a stone image from ps.bin and the kern/user/rsrc (and blk_*) files unpack_stone writes
+    # sections stay at their addresses from the ps.bin table while they fit, so ps.bin comes back unchanged then
+    # section types come from the index unpack_stone leaves next to the files, without it they're written as 0
+    # jobs > 1 compresses the LZMA blocks in that many processes, returns the source and image sizes and the time taken
+    psPath = srcDir + '/ps.bin'
+    psData = readFile(psPath)
+    startPos = psData.find(b'TRAPGAMI')
+    assert startPos > 0, 'No stone header found in %s' % psPath
+    sectionOffset = 0
+    if psData[0:15] == b'SPRD-SECUREFLAG': # the signature won't match any more, but the layout is kept
+        sectionOffset = 1024
+    oldTable = [addr for addr in struct.unpack_from('<28L', psData, startPos+8) if addr < 0xffffffff]
+    extra = sorted(n for n in os.listdir(srcDir) if n.startswith('blk_') and n.endswith('.bin'))
+    layout = [(packLayout[0][0], packLayout[0][1] + [(int(n[4:-4], 16), n) for n in extra])] + packLayout[1:]
+    sections = []
+    srcSize = len(psData)
+    for magic, blocks in layout:
+        present = [(blkId, srcDir + '/' + n) for blkId, n in blocks if os.path.exists(srcDir + '/' + n)]
+        if present:
+            sections.append((magic, present))
+            srcSize += sum(os.path.getsize(f) for blkId, f in present)
+    assert sections, 'Nothing to pack in %s' % srcDir
+    secTypes = {}
+    if os.path.exists(srcDir + '/' + indexName):
+        import json
+        index = json.loads(readFile(srcDir + '/' + indexName))
+        for section in index['sections']:
+            secTypes[struct.unpack('<L', section['magic'].encode('latin-1'))[0]] = section['type']
+            for blk in section['blocks']: # only plain LZMA can be compressed here, the device expects what it had
+                assert blk['compression'] == 'lzma', 'Block %s was compressed with %s, which can not be packed yet' % (blk['name'], blk['compression'])
+    else:
+        print('No %s in %s, section types are written as 0' % (indexName, srcDir))
+    pool = None
+    if jobs > 1:
+        import multiprocessing
+        pool = multiprocessing.Pool(jobs)
+    start = time.perf_counter()
+    try:
+        with open(fname, 'wb') as outf:
+            outf.write(psData)
+            outf.write(b'\xff' * sectionOffset)
+            table = []
+            for i, (magic, blocks) in enumerate(sections):
+                addr = outf.tell() - sectionOffset
+                if i < len(oldTable) and oldTable[i] > addr:
+                    outf.write(b'\xff' * (oldTable[i] - addr))
+                    addr = oldTable[i]
+                table.append(addr)
+                pack_section(outf, magic, blocks, chunkSize, pool, secTypes.get(magic, 0))
+                outf.write(b'\xff' * (-(outf.tell() - sectionOffset) & 0xfff)) # sections start on 4K boundaries
+            table += [0xffffffff] * (28 - len(table))
+            outf.seek(startPos + 8)
+            outf.write(struct.pack('<28L', *table))
+    finally:
+        if pool is not None:
+            pool.terminate()
+    elapsed = time.perf_counter() - start
+    imgSize = os.path.getsize(fname)
+    print('Packed %d bytes into %d in %.3f s with %d jobs (%.2f MB/s)' % (srcSize, imgSize, elapsed, jobs, srcSize / max(elapsed, 1e-9) / 1e6))
+    return {'bytes': srcSize, 'packedBytes': imgSize, 'jobs': jobs, 'seconds': elapsed}
 
 # main code start
 
 if __name__ == '__main__': # main app start
     from argparse import ArgumentParser
     rootdir = os.path.dirname(os.path.realpath(__file__))
-    parser = ArgumentParser(description='StoneD: an opensource Unisoc/Spreadtrum stone image unpacker', epilog='(c) Luxferre 2021 --- No rights reserved <https://unlicense.org>')
-    parser.add_argument('file', help='Stone image file to unpack')
-    parser.add_argument('-d','--directory', default=None, help='Directory where component files will be written to (defaults to the same where the main stone file resides)')
+    parser = ArgumentParser(description='StoneD: an opensource Unisoc/Spreadtrum stone image unpacker and packer', epilog='(c) Luxferre 2021 --- No rights reserved <https://unlicense.org>')
+    parser.add_argument('file', help='Stone image file to unpack, or to create with --pack')
+    parser.add_argument('-d','--directory', default=None, help='Directory where component files will be written to, or read from with --pack (defaults to the same where the main stone file resides)')
+    parser.add_argument('-j','--jobs', type=int, default=1, help='Number of processes (de)compressing LZMA blocks in parallel (defaults to 1)')
+    parser.add_argument('-p','--pack', action='store_true', help='Pack ps.bin, kern.bin, user.bin and rsrc.bin from the directory into the stone file instead (section types come from the stone.json index unpacking leaves there)')
+    parser.add_argument('-C','--cache', nargs='?', const='', default=None, help='Keep decompressed blocks in this directory (defaults to ~/.cache/uniflash/stoned if given without one) and reuse them, unpacked files are copied out of it')
+    parser.add_argument('-cs','--cache-size', type=int, default=512, help='Cache size limit in MB, least recently used entries go first (defaults to 512)')
+    parser.add_argument('-l','--list', action='store_true', help='Print the JSON index of sections and blocks read from the headers instead, nothing is decompressed')
+    parser.add_argument('-x','--extract', default=None, help='Only extract this block (id or file name like rsrc.bin), decompressing just the LZMA blocks the requested range needs')
+    parser.add_argument('-s','--start', type=lambda x: int(x, 0), default=0, help='Position in the unpacked block to extract from (defaults to 0)')
+    parser.add_argument('-n','--length', type=lambda x: int(x, 0), default=None, help='Number of bytes to extract (defaults to the rest of the block)')
+    parser.add_argument('-o','--output', default=None, help='File to write the extracted bytes to (defaults to the block file name in the directory)')
+    parser.add_argument('-c','--chunk-size', type=lambda x: int(x, 0), default=0x10000, help='Uncompressed size of every LZMA block when packing (defaults to 0x10000)')
 
     args = parser.parse_args()
 
@@ -150,6 +616,28 @@ if __name__ == '__main__': # main app start
     if args.directory is not None:
         imgdir = os.path.realpath(args.directory)
 
-    print('Unpacking %s to %s' % (imgfile, imgdir))
-    unpack_stone(imgfile, imgdir)
+    if args.list:
+        import json
+        print(json.dumps(stone_index(imgfile), indent=1))
+    elif args.extract is not None:
+        block = args.extract
+        try:
+            block = int(block, 0)
+        except ValueError:
+            pass
+        data = extract_block(imgfile, block, args.start, args.length)
+        outName = args.output
+        if outName is None:
+            outName = imgdir + '/' + find_block(stone_index(imgfile), block)['name']
+        writeFile(outName, data)
+        print('%d bytes of %s written to %s' % (len(data), args.extract, outName))
+    elif args.pack:
+        print('Packing %s into %s' % (imgdir, imgfile))
+        pack_stone(imgdir, imgfile, args.jobs, args.chunk_size)
+    else:
+        cache = None
+        if args.cache is not None:
+            cache = BlockCache(args.cache or None, args.cache_size << 20)
+        print('Unpacking %s to %s' % (imgfile, imgdir))
+        unpack_stone(imgfile, imgdir, args.jobs, cache)
 
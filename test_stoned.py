@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+# StoneD tests on a synthetic stone image
+# Released into public domain
+
+import os
+import io, json, tempfile
+import unittest
+from contextlib import redirect_stdout
+import stoned, unifixtures
+
+class StoneTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.dir = self.tmp.name
+        self.stone = self.path('stone.bin')
+        self.parts = unifixtures.synthetic_stone(self.stone, 0x30000, 0x8000, 0x50000, 0x10000, sectionTypes=(1, 2))
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def path(self, *names):
+        return os.path.join(self.dir, *names)
+
+    def unpack(self, outDir, cache = None):
+        os.makedirs(outDir, exist_ok=True)
+        with redirect_stdout(io.StringIO()):
+            stoned.unpack_stone(self.stone, outDir, 1, cache)
+
+    def read_file(self, name):
+        with open(name, 'rb') as f:
+            return f.read()
+
+class BlockCacheTest(StoneTestCase):
+    def test_private_copies(self): # unpacked files never share an inode with the cache
+        cache = stoned.BlockCache(self.path('cache'))
+        for run in range(2):
+            outDir = self.path('out%d' % run)
+            self.unpack(outDir, cache)
+            for name, data in self.parts.items():
+                st = os.stat(os.path.join(outDir, name))
+                self.assertEqual(st.st_nlink, 1)
+                self.assertTrue(st.st_mode & 0o200)
+                self.assertEqual(self.read_file(os.path.join(outDir, name)), data)
+        self.assertEqual(cache.stats['fileHits'], 3)
+        with open(self.path('out1', 'kern.bin'), 'r+b') as f: # editing an unpacked file leaves the cache alone
+            f.write(b'\0' * 0x100)
+        self.unpack(self.path('out2'), cache)
+        self.assertEqual(self.read_file(self.path('out2', 'kern.bin')), self.parts['kern.bin'])
+        self.assertEqual([name for name in os.listdir(self.path('cache')) if name.endswith('.tmp')], [])
+
+class IndexTest(StoneTestCase):
+    def test_index(self):
+        index = stoned.stone_index(self.stone)
+        self.assertEqual(index['psSize'], len(self.parts['ps.bin']))
+        blocks = [blk for section in index['sections'] for blk in section['blocks']]
+        self.assertEqual([blk['name'] for blk in blocks], ['kern.bin', 'user.bin', 'rsrc.bin'])
+        for blk in blocks: # the synthetic streams only have end markers, so the headers don't tell the unpacked size
+            self.assertIn(blk['unpackedSize'], (None, len(self.parts[blk['name']])))
+            self.assertEqual(len(blk['chunks']), (len(self.parts[blk['name']]) + 0xffff) // 0x10000)
+        self.assertIs(stoned.find_block(index, 'rsrc'), blocks[2])
+        self.assertIs(stoned.find_block(index, 0x75736572), blocks[1])
+        with self.assertRaises(AssertionError):
+            stoned.find_block(index, 'blk_1234.bin')
+
+    def test_extract(self):
+        kern = self.parts['kern.bin']
+        self.assertEqual(stoned.extract_block(self.stone, 'kern.bin'), kern)
+        self.assertEqual(stoned.extract_block(self.stone, 0x7253736F), self.parts['rsrc.bin'])
+        for start, length in ((0, 0x10), (0xfff0, 0x20), (0x10000, 0x10000), (0x1fffe, 0x10003), (len(kern) - 3, None), (len(kern), 0x10)):
+            end = None if length is None else start + length
+            self.assertEqual(stoned.extract_block(self.stone, 'kern', start, length), kern[start:end])
+
+    def test_extract_matches_unpack(self):
+        self.unpack(self.dir)
+        for name in ('kern.bin', 'user.bin', 'rsrc.bin'):
+            self.assertEqual(stoned.extract_block(self.stone, name, 0x1234, 0x5000), self.read_file(self.path(name))[0x1234:0x6234])
+
+class RepackTest(StoneTestCase):
+    def repack(self, jobs): # unpack, pack again and unpack the new image, returns the directory of the last unpack
+        srcDir = self.path('src')
+        self.unpack(srcDir)
+        packName = self.path('repacked-%d.bin' % jobs)
+        with redirect_stdout(io.StringIO()):
+            stoned.pack_stone(srcDir, packName, jobs)
+            checkDir = self.path('check-%d' % jobs)
+            os.mkdir(checkDir)
+            stoned.unpack_stone(packName, checkDir)
+        return packName, checkDir
+
+    def test_round_trip(self):
+        original = stoned.stone_index(self.stone)
+        for jobs in (1, 2):
+            packName, checkDir = self.repack(jobs)
+            for name, data in self.parts.items():
+                self.assertEqual(self.read_file(os.path.join(checkDir, name)), data)
+            repacked = stoned.stone_index(packName)
+            self.assertEqual([(s['address'], s['magic'], s['type']) for s in repacked['sections']], [(s['address'], s['magic'], s['type']) for s in original['sections']])
+            self.assertEqual([s['type'] for s in repacked['sections']], [1, 2])
+
+    def test_other_compression(self): # blocks the packer can't compress the same way are refused
+        srcDir = self.path('src')
+        self.unpack(srcDir)
+        indexPath = os.path.join(srcDir, stoned.indexName)
+        with open(indexPath) as f:
+            index = json.load(f)
+        index['sections'][1]['blocks'][0]['compression'] = 'lzma_spd'
+        with open(indexPath, 'w') as f:
+            json.dump(index, f)
+        with self.assertRaises(AssertionError):
+            with redirect_stdout(io.StringIO()):
+                stoned.pack_stone(srcDir, self.path('repacked.bin'))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+# Equivalence tests of the unicmd checksums and HDLC codec against byte-by-byte reference implementations
+# Released into public domain
+
+import os
+import unittest
+import unicmd
+from unifixtures import ref_crc16_xmodem, ref_crc16_fdl, ref_chksum32, ref_hdlc_encode, ref_hdlc_decode, escaped_payload
+
+class ChecksumTest(unittest.TestCase):
+    def samples(self):
+        samples = [b'', b'\x00', b'\xff', b'\x7e\x7d', bytes(range(256)) * 3 + b'\x01']
+        samples += [os.urandom(n) for n in (1, 2, 3, 511, 4096, 4097, 65537)]
+        samples.append(b'\xff' * 300000) # large enough for the FDL sum to need the double fold
+        return samples
+
+    def check(self, fast, ref):
+        for s in self.samples():
+            expected = ref(s)
+            self.assertEqual(fast(s), expected, '%d bytes' % len(s))
+            self.assertEqual(fast(memoryview(s)), expected, '%d-byte memoryview' % len(s))
+            self.assertEqual(fast(bytearray(s)), expected, '%d-byte bytearray' % len(s))
+
+    def test_crc16_xmodem(self):
+        self.check(unicmd.crc16_xmodem, ref_crc16_xmodem)
+
+    def test_crc16_fdl(self):
+        self.check(unicmd.crc16_fdl, ref_crc16_fdl)
+
+    def test_chksum32(self):
+        self.check(unicmd.chksum32, ref_chksum32)
+
+class HdlcCodecTest(unittest.TestCase):
+    def test_equivalence(self):
+        for size in (0, 1, 2, 255, 4096):
+            for density in (0, 0.01, 0.5, 1):
+                data = escaped_payload(size, density)
+                for fdl in (False, True):
+                    frame = unicmd.hdlc_encode(data, fdl)
+                    self.assertEqual(frame, ref_hdlc_encode(data, fdl), 'encoder on %d bytes' % size)
+                    self.assertEqual(unicmd.hdlc_encode(memoryview(data), fdl), frame, 'encoder on a %d-byte memoryview' % size)
+                    self.assertEqual(unicmd.hdlc_decode(frame, fdl), ref_hdlc_decode(frame, fdl), 'decoder on %d bytes' % size)
+                    self.assertEqual(unicmd.hdlc_decode(bytearray(frame), fdl), data, 'decoder on a %d-byte bytearray' % size)
+
+    def test_encode_returns_bytes(self):
+        self.assertIs(type(unicmd.hdlc_encode(b'\x7e\x00')), bytes)
+        self.assertIs(type(unicmd.hdlc_encode(b'\x00')), bytes)
+
+    def test_invalid_escape(self):
+        with self.assertRaises(Exception):
+            unicmd.hdlc_decode(b'\x7e\x7d\x00\x00\x00\x7e')
+
+class HdlcStreamTest(unittest.TestCase):
+    def payloads(self):
+        return [escaped_payload(n, d) for n, d in ((1, 0), (10, 0.5), (300, 0.1), (4096, 0.01))]
+
+    def test_split_anywhere(self): # frames fed in pieces of any size come out whole and in order
+        payloads = self.payloads()
+        stream = b''.join(unicmd.hdlc_encode(p, True) for p in payloads)
+        for piece in (1, 2, 7, 1000, len(stream)):
+            parser = unicmd.HdlcStream()
+            got = []
+            for pos in range(0, len(stream), piece):
+                parser.feed(stream[pos:pos+piece])
+                got += [bytes(f) for f in parser.frames(True)]
+            self.assertEqual(got, payloads, 'fed in %d-byte pieces' % piece)
+            self.assertEqual(parser.pending(), 0)
+
+    def test_noise_and_double_flags(self):
+        parser = unicmd.HdlcStream()
+        frame = unicmd.hdlc_encode(b'\x00\x80\x00\x00')
+        parser.feed(b'\x01\x02' + frame[:1] + frame + b'\x7e' + frame[:5])
+        self.assertEqual([bytes(f) for f in parser.frames()], [b'\x00\x80\x00\x00'])
+        self.assertIsNone(parser.next_frame())
+        parser.feed(frame[5:])
+        self.assertEqual(bytes(parser.next_frame()), b'\x00\x80\x00\x00')
+
+    def test_reset(self):
+        parser = unicmd.HdlcStream()
+        parser.feed(unicmd.hdlc_encode(b'\x01\x02')[:-1])
+        self.assertIsNone(parser.next_frame())
+        parser.reset()
+        self.assertEqual(parser.pending(), 0)
+        parser.feed(unicmd.hdlc_encode(b'\x03\x04'))
+        self.assertEqual(bytes(parser.next_frame()), b'\x03\x04')
+
+if __name__ == '__main__':
+    unittest.main()
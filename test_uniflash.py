@@ -0,0 +1,309 @@
+#!/usr/bin/env python
+# UniFlash session tests against the emulated device
+# Released into public domain
+
+import os
+import io, tempfile
+import threading
+import unittest
+from contextlib import redirect_stdout
+from struct import unpack_from
+import uniflash, uniemu, unicmd
+
+class FlakyTransport(uniemu.EmuTransport): # drops the connection after a number of reads
+    def __init__(self, device, readsLeft = None):
+        super().__init__(device)
+        self.readsLeft = readsLeft
+
+    def read(self, buf, timeout):
+        if self.readsLeft is not None:
+            if self.readsLeft <= 0:
+                raise IOError('Device went away')
+            self.readsLeft -= 1
+        return super().read(buf, timeout)
+
+class EmuTestCase(unittest.TestCase):
+    # a session with a running FDL and a NOR image holding self.image
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.dir = self.tmp.name
+        self.image = os.urandom(0x80000)
+        norName = self.path('nor.bin')
+        with open(norName, 'wb') as nf:
+            nf.write(self.image + b'\xff' * (uniemu.EMU_NOR_SIZE - len(self.image)))
+        self.dev = uniemu.EmulatedDevice(norName)
+        self.dev.stage = 'fdl' # skip the bootstrap
+        self.sessions = []
+
+    def tearDown(self):
+        for session in self.sessions:
+            session.close()
+        self.dev.close()
+        self.tmp.cleanup()
+
+    def path(self, name):
+        return os.path.join(self.dir, name)
+
+    def session(self, readsLeft = None):
+        session = uniflash.UniSession(FlakyTransport(self.dev, readsLeft))
+        self.sessions.append(session)
+        with redirect_stdout(io.StringIO()):
+            session.connect()
+        return session
+
+    def run_quiet(self, fn, *args, **kwargs):
+        with redirect_stdout(io.StringIO()):
+            return fn(*args, **kwargs)
+
+    def read_file(self, name):
+        with open(name, 'rb') as f:
+            return f.read()
+
+    def write_image(self, data):
+        name = self.path('image.bin')
+        with open(name, 'wb') as f:
+            f.write(data)
+        return name
+
+    def assertFlashed(self, data, offset): # the image is in place and the flash around it untouched
+        self.assertEqual(bytes(self.dev.nor[offset:offset+len(data)]), data)
+        self.assertEqual(bytes(self.dev.nor[:offset]), self.image[:offset])
+        self.assertEqual(bytes(self.dev.nor[offset+len(data):len(self.image)]), self.image[offset+len(data):])
+
+class EmulatedNorTest(EmuTestCase):
+    def test_write_clears_bits(self): # without an erase the old contents show through
+        session = self.session()
+        self.run_quiet(session.send_file_to_addr, memoryview(b'\x0f' * 0x100), uniflash.UNISOC_FLASH_BASE_ADDR, True, True, 0x100)
+        self.assertEqual(bytes(self.dev.nor[:0x100]), bytes(b & 0x0f for b in self.image[:0x100]))
+
+    def test_erase_whole_sectors(self):
+        self.run_quiet(self.session().erase_flash_mem, 0x100, uniflash.UNISOC_FLASH_BASE_ADDR + 0x10010)
+        self.assertEqual(bytes(self.dev.nor[0x10000:0x20000]), b'\xff' * 0x10000)
+        self.assertEqual(bytes(self.dev.nor[:0x10000]), self.image[:0x10000])
+        self.assertEqual(bytes(self.dev.nor[0x20000:0x80000]), self.image[0x20000:])
+
+class FlashWriteTest(EmuTestCase):
+    def test_unaligned_erase(self):
+        data = os.urandom(0x12345)
+        self.run_quiet(self.session().write_flash_mem, self.write_image(data), 0x1800, 0x1000, True)
+        self.assertFlashed(data, 0x1800)
+
+    def test_unaligned_sparse(self):
+        data = os.urandom(0x8000) + b'\xff' * 0x20000 + os.urandom(0x100)
+        self.dev.nor[0x20000:0x30000] = b'\xff' * 0x10000 # the skipped sector has to be erased already
+        self.image = bytes(self.dev.nor[:len(self.image)])
+        self.run_quiet(self.session().write_flash_mem, self.write_image(data), 0xc000, 0x1000, False, sparse=True)
+        self.assertFlashed(data, 0xc000)
+        self.assertEqual(self.dev.stats['erased'], 0x30000) # the sectors at 0, 0x10000 and 0x30000
+
+    def test_run_inside_a_sector(self):
+        data = os.urandom(0x123)
+        self.run_quiet(self.session().write_flash_mem, self.write_image(data), 0x20010, 0x1000, True)
+        self.assertFlashed(data, 0x20010)
+
+class DiffFlashTest(EmuTestCase):
+    def test_changed_edge_sectors(self): # only the changed sectors are written, the flash around the image stays
+        data = bytearray(self.image[0x1800:0x23b45])
+        data[0x10:0x20] = os.urandom(0x10) # first sector, partly outside the image
+        data[-0x10:] = os.urandom(0x10) # last sector, partly outside the image
+        data = bytes(data)
+        self.run_quiet(self.session().diff_flash_mem, self.write_image(data), 0x1800, 0x1000, 0x80000003, 0x1000)
+        self.assertFlashed(data, 0x1800)
+        self.assertEqual(self.dev.stats['erased'], 0x20000)
+
+    def test_unchanged(self):
+        self.run_quiet(self.session().diff_flash_mem, self.write_image(self.image[0x800:0x30000]), 0x800, 0x1000, 0x80000003, 0x1000)
+        self.assertEqual(bytes(self.dev.nor[:len(self.image)]), self.image)
+        self.assertEqual(self.dev.stats['erased'], 0)
+
+class VerifyTest(EmuTestCase):
+    def spoil_writes(self, count, start): # the next count data frames ending past start leave their last byte wrong, as if it didn't program
+        handle = self.dev.handle
+        def spoiled(frame):
+            handle(frame)
+            nonlocal count
+            dl = self.dev.download
+            if count > 0 and len(frame) >= 4 and unpack_from('>H', frame)[0] == unicmd.BSL_CMD_MIDST_DATA and dl['offset'] is not None and dl['offset'] + dl['done'] > start:
+                count -= 1
+                pos = dl['offset'] + dl['done'] - 1
+                self.dev.nor[pos] ^= 0x55
+        self.dev.handle = spoiled
+
+    def test_reflash_mismatch(self):
+        data = os.urandom(0x23456)
+        session = self.session()
+        self.spoil_writes(1, 0x1800)
+        out = io.StringIO()
+        with redirect_stdout(out):
+            session.write_flash_mem(self.write_image(data), 0x1800, 0x1000, True, verify=True)
+        self.assertIn('Re-flashing 1 mismatching runs', out.getvalue())
+        self.assertIn('Flash contents verified!', out.getvalue())
+        self.assertEqual(session.trace.retries, {'verify re-flash': 1})
+        self.assertFlashed(data, 0x1800)
+
+    def test_persistent_mismatch(self): # every re-flash fails too, verification gives up after verifyRetries
+        data = os.urandom(0x8000)
+        self.spoil_writes(1000, 0x10000)
+        with self.assertRaises(AssertionError):
+            self.run_quiet(self.session().write_flash_mem, self.write_image(data), 0x10000, 0x1000, True, sparse=True, verify=True)
+
+class QueuedReadTest(EmuTestCase):
+    def test_fallback(self): # an FDL that drops READ_FLASH requests arriving before the previous reply went out
+        handle = self.dev.handle
+        def unqueued(frame):
+            if len(frame) >= 4 and unpack_from('>H', frame)[0] == unicmd.BSL_CMD_READ_FLASH and self.dev.outq:
+                return
+            handle(frame)
+        self.dev.handle = unqueued
+        outName = self.path('dump.bin')
+        session = self.session()
+        out = io.StringIO()
+        with redirect_stdout(out):
+            session.read_partition(0x80000003, 0x20000, 0x800, outName, 0x1000, depth=4)
+        self.assertIn('falling back to queue depth 1', out.getvalue())
+        self.assertEqual(session.trace.retries, {'queued read fallback': 1})
+        self.assertEqual(self.read_file(outName), self.image[0x800:0x20800])
+
+    def test_queued(self):
+        outName = self.path('dump.bin')
+        session = self.session()
+        self.run_quiet(session.read_partition, 0x80000003, 0x20000, 0x800, outName, 0x1000, depth=4)
+        self.assertEqual(session.trace.retries, {})
+        self.assertEqual(self.read_file(outName), self.image[0x800:0x20800])
+
+class DumpJournalTest(EmuTestCase):
+    def test_short_dump(self): # shorter than journalInterval, the journal is still cleaned up
+        outName = self.path('short.bin')
+        self.run_quiet(self.session().read_partition, 0x80000003, 0x3000, 0, outName, 0x1000)
+        self.assertEqual(self.read_file(outName), self.image[:0x3000])
+        self.assertFalse(os.path.exists(uniflash.journal_path(outName)))
+
+    def test_resume(self):
+        outName = self.path('dump.bin')
+        with self.assertRaises(IOError):
+            self.run_quiet(self.session(100).read_partition, 0x80000003, len(self.image), 0, outName, 0x1000)
+        self.assertTrue(os.path.exists(uniflash.journal_path(outName)))
+        session = self.session()
+        out = io.StringIO()
+        with redirect_stdout(out):
+            session.read_partition(0x80000003, len(self.image), 0, outName, 0x1000, resume=True)
+        self.assertIn('Resuming dump after', out.getvalue())
+        self.assertLess(session.moved, len(self.image))
+        self.assertEqual(self.read_file(outName), self.image)
+        self.assertFalse(os.path.exists(uniflash.journal_path(outName)))
+
+    def test_resume_other_range(self): # a journal for another range is ignored
+        outName = self.path('dump.bin')
+        with self.assertRaises(IOError):
+            self.run_quiet(self.session(100).read_partition, 0x80000003, len(self.image), 0, outName, 0x1000)
+        out = io.StringIO()
+        with redirect_stdout(out):
+            self.session().read_partition(0x80000003, 0x10000, 0x1000, outName, 0x1000, resume=True)
+        self.assertIn('starting from scratch', out.getvalue())
+        self.assertEqual(self.read_file(outName), self.image[0x1000:0x11000])
+
+class PrefetchTest(EmuTestCase):
+    def test_rejected_short_flash(self): # the device refuses the first frame while the producer is blocked on a full queue
+        self.dev.maxPacketSize = 0x1000
+        self.dev.latency = 0.05
+        data = os.urandom(0x2000 * (uniflash.writeQueueDepth + 1))
+        errors = []
+        def flash():
+            try:
+                self.run_quiet(self.session().send_file_to_addr, memoryview(data), uniflash.UNISOC_FLASH_BASE_ADDR, True, True, 0x2000)
+            except AssertionError as e:
+                errors.append(e)
+        t = threading.Thread(target=flash, daemon=True)
+        t.start()
+        t.join(10)
+        self.assertFalse(t.is_alive(), 'send_file_to_addr hangs after a NAK')
+        self.assertEqual(len(errors), 1)
+        self.assertIn('response code is 8A', str(errors[0]))
+
+class BlockSizeProbeTest(EmuTestCase):
+    def setUp(self):
+        super().setUp()
+        self.saved = (uniflash.autoBlockSize, os.environ.get('XDG_CACHE_HOME'))
+        uniflash.autoBlockSize = True
+        os.environ['XDG_CACHE_HOME'] = self.path('cache') # start without cached block sizes
+
+    def tearDown(self):
+        uniflash.autoBlockSize = self.saved[0]
+        if self.saved[1] is None:
+            del os.environ['XDG_CACHE_HOME']
+        else:
+            os.environ['XDG_CACHE_HOME'] = self.saved[1]
+        super().tearDown()
+
+    def flash(self, session, data, offset):
+        addr = uniflash.UNISOC_FLASH_BASE_ADDR + offset
+        out = io.StringIO()
+        with redirect_stdout(out):
+            session.erase_flash_mem(len(data), addr)
+            session.send_file_to_addr(memoryview(data), addr, True, True, 0x1000)
+        return out.getvalue()
+
+    def test_short_transfers_do_not_probe(self):
+        session = self.session()
+        for i in range(3):
+            log = self.flash(session, os.urandom(0x2000), i * 0x10000)
+            self.assertNotIn('not supported', log)
+            self.assertNotIn('Probing', log)
+        self.assertEqual(session.trace.retries, {})
+
+    def test_probe_once_per_session(self):
+        session = self.session()
+        data = os.urandom(uniflash.tuneProbeSize * (len(uniflash.blockSizeCandidates) + 1))
+        self.assertIn('Locked in write block size', self.flash(session, data, 0))
+        self.assertNotIn('block size', self.flash(session, data, 0))
+        self.assertEqual(bytes(self.dev.nor[:len(data)]), data)
+        self.assertEqual(session.trace.retries, {})
+
+class CacheTest(unittest.TestCase):
+    fdlDir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fdls')
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.saved = os.environ.get('XDG_CACHE_HOME')
+        os.environ['XDG_CACHE_HOME'] = self.tmp.name
+
+    def tearDown(self):
+        if self.saved is None:
+            del os.environ['XDG_CACHE_HOME']
+        else:
+            os.environ['XDG_CACHE_HOME'] = self.saved
+        self.tmp.cleanup()
+
+    def fdl_name(self):
+        target = uniflash.load_targets(self.fdlDir)['sc6530_generic']
+        return target['single'][0]
+
+    def test_unusable_cache(self): # the cache directory can't be created, everything is worked out live
+        cacheFile = os.path.join(self.tmp.name, 'file')
+        with open(cacheFile, 'w'):
+            pass
+        os.environ['XDG_CACHE_HOME'] = cacheFile
+        fname = self.fdl_name()
+        frames = uniflash.fdl_frames(fname, 0x800)
+        with uniflash.ImageSource(fname) as src:
+            expected = list(uniflash.data_frames(src.data, 0x800, False))
+        self.assertEqual([(size, bytes(frame)) for size, frame in frames.frames()], [(size, bytes(frame)) for size, frame in expected])
+
+    def test_concurrent_frames(self): # station threads encoding the same FDL at once
+        fname = self.fdl_name()
+        errors = []
+        def encode():
+            try:
+                uniflash.fdl_frames(fname, 0x800)
+            except Exception as e:
+                errors.append(e)
+        threads = [threading.Thread(target=encode) for i in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(errors, [])
+        self.assertEqual([name for name in os.listdir(os.path.join(self.tmp.name, 'uniflash')) if name.endswith('.tmp')], [])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+# UniSparse container tests
+# Released into public domain
+
+import os
+import tempfile
+import unittest
+import unisparse, uniflash
+import test_uniflash
+
+def sample_image(): # random data with erased runs, one of them a whole chunk
+    return os.urandom(0x3000) + b'\xff' * 0x2000 + os.urandom(0x1800) + b'\xff' * 0x800 + os.urandom(0x123)
+
+class ContainerTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.name = os.path.join(self.tmp.name, 'dump.usp')
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def pack(self, data, codec = 'zlib', chunkSize = 0x1000):
+        writer = unisparse.SparseWriter(self.name, codec, chunkSize, 0x80000003, 0x1000)
+        for pos in range(0, len(data), 0x700): # writes don't line up with chunks
+            writer.write(memoryview(data)[pos:pos+0x700])
+        return writer.close()
+
+    def test_round_trip(self):
+        data = sample_image()
+        for codec in unisparse.codecFlags:
+            stats = self.pack(data, codec)
+            self.assertEqual(stats['length'], len(data))
+            self.assertEqual(stats['chunks'], 8)
+            self.assertEqual(stats['erased'], 2)
+            image = unisparse.SparseImage(self.name)
+            self.assertTrue(unisparse.is_container(self.name))
+            self.assertEqual((image.partid, image.start, image.length), (0x80000003, 0x1000, len(data)))
+            self.assertTrue(image.verify())
+            self.assertEqual(b''.join(image.chunk(i) for i in range(len(image.index))), data)
+            for pos, size in ((0, 0x1000), (0xfff, 2), (0x2800, 0x3000), (len(data) - 5, 5)):
+                self.assertEqual(image.read(pos, size).tobytes(), data[pos:pos+size])
+            image.close()
+
+    def test_corrupted_chunk(self):
+        data = os.urandom(0x2000)
+        self.pack(data)
+        with open(self.name, 'r+b') as f:
+            f.seek(unisparse.HEADER.size + 0x10)
+            f.write(b'\0' * 4)
+        image = unisparse.SparseImage(self.name)
+        with self.assertRaises(AssertionError):
+            image.chunk(0)
+        self.assertEqual(image.chunk(1), data[0x1000:])
+        image.close()
+
+    def test_interrupted(self): # a container without an index is refused
+        writer = unisparse.SparseWriter(self.name)
+        writer.write(os.urandom(0x30000))
+        writer.abort()
+        with self.assertRaises(AssertionError):
+            unisparse.SparseImage(self.name)
+
+    def test_view_slices(self): # slices a packet can carry come back as memoryviews even with small chunks
+        data = sample_image() * 4
+        self.pack(data, chunkSize = 0x1000)
+        with unisparse.SparseSource(self.name, 0x800, 0x18000) as src:
+            part = src.data[0x100:0x2100]
+            self.assertIsInstance(part, memoryview)
+            self.assertEqual(part.tobytes(), data[0x900:0x2900])
+            rest = src.data[0x100:]
+            self.assertIsInstance(rest, unisparse.SparseView)
+            self.assertEqual(rest.tobytes(), data[0x900:0x18800])
+
+class SparseFlashTest(test_uniflash.EmuTestCase):
+    def test_flash_small_chunks(self): # container chunks smaller than the write block size
+        data = sample_image()
+        name = self.path('image.usp')
+        writer = unisparse.SparseWriter(name, 'zlib', 0x1000)
+        writer.write(data)
+        writer.close()
+        session = self.session()
+        self.run_quiet(session.write_flash_mem, name, 0, 0x2000, True)
+        self.assertEqual(bytes(self.dev.nor[:len(data)]), data)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,207 @@
+#!/usr/bin/env python
+# UniBench - benchmarks for the UniFlash hot paths
+# Released into public domain
+
+import os
+import sys
+import time
+import io, json, platform, tempfile
+import subprocess
+from contextlib import redirect_stdout
+import unicmd
+from unifixtures import ref_crc16_xmodem, ref_crc16_fdl, ref_chksum32, ref_hdlc_encode, ref_hdlc_decode, escaped_payload, synthetic_stone
+
+# the fast implementations are checked against the reference ones in test_unicmd before they're timed
+
+CHECKSUMS = [
+    ('crc16_xmodem', unicmd.crc16_xmodem, ref_crc16_xmodem),
+    ('crc16_fdl', unicmd.crc16_fdl, ref_crc16_fdl),
+    ('chksum32', unicmd.chksum32, ref_chksum32)
+]
+
+# timing helpers
+
+def run_checks(*names): # the given test_unicmd cases, benchmarks of broken code are pointless
+    import unittest
+    suite = unittest.defaultTestLoader.loadTestsFromNames(['test_unicmd.' + n for n in names])
+    result = unittest.TextTestRunner(stream=io.StringIO()).run(suite)
+    assert result.wasSuccessful(), 'Equivalence checks failed: %s' % '; '.join(str(t) for t, tb in result.failures + result.errors)
+    print('%s: OK' % ', '.join(names))
+
+def timeit(fn, *args, minTime = 0.2):
+    runs = 0
+    start = time.perf_counter()
+    while True:
+        fn(*args)
+        runs += 1
+        elapsed = time.perf_counter() - start
+        if elapsed >= minTime:
+            return elapsed / runs
+
+def bench_checksums(sizes, results):
+    print('%-14s %10s %12s %12s %9s' % ('function', 'bytes', 'ref MB/s', 'fast MB/s', 'speedup'))
+    for size in sizes:
+        data = os.urandom(size)
+        for name, fast, ref in CHECKSUMS:
+            tRef = timeit(ref, data)
+            tFast = timeit(fast, data)
+            print('%-14s %10d %12.2f %12.2f %8.1fx' % (name, size, size / tRef / 1e6, size / tFast / 1e6, tRef / tFast))
+            results.append({'bench': 'checksum', 'name': name, 'bytes': size, 'refMBps': size / tRef / 1e6, 'MBps': size / tFast / 1e6})
+
+def bench_hdlc(sizes, results, densities = (0, 0.01, 0.1)):
+    print('%-14s %10s %8s %12s %12s %9s' % ('function', 'bytes', 'escapes', 'ref MB/s', 'fast MB/s', 'speedup'))
+    for size in sizes:
+        for density in densities:
+            data = escaped_payload(size, density)
+            frame = unicmd.hdlc_encode(data, True)
+            for name, fast, ref, arg in (('hdlc_encode', unicmd.hdlc_encode, ref_hdlc_encode, data), ('hdlc_decode', unicmd.hdlc_decode, ref_hdlc_decode, frame)):
+                tRef = timeit(ref, arg, True)
+                tFast = timeit(fast, arg, True)
+                print('%-14s %10d %7d%% %12.2f %12.2f %8.1fx' % (name, size, density * 100, size / tRef / 1e6, size / tFast / 1e6, tRef / tFast))
+                results.append({'bench': 'hdlc', 'name': name, 'bytes': size, 'escapeDensity': density, 'refMBps': size / tRef / 1e6, 'MBps': size / tFast / 1e6})
+
+# flash/dump loops against the emulated device
+
+def bench_transfer(size, blockSizes, latency, results):
+    import uniflash, uniemu
+    print('%-8s %10s %8s %6s %6s %9s %9s' % ('op', 'bytes', 'block', 'queue', 'lat ms', 'seconds', 'MB/s'))
+    with tempfile.TemporaryDirectory() as tmp:
+        imgName = os.path.join(tmp, 'img.bin')
+        outName = os.path.join(tmp, 'dump.bin')
+        img = os.urandom(size)
+        with open(imgName, 'wb') as imgf:
+            imgf.write(img)
+        dev = uniemu.EmulatedDevice(os.path.join(tmp, 'nor.bin'), latency / 1000)
+        assert size <= len(dev.nor), 'Transfer size is bigger than the emulated flash (%d bytes)' % len(dev.nor)
+        dev.stage = 'fdl' # skip the bootstrap, the FDL is already running
+        session = uniflash.UniSession(uniemu.EmuTransport(dev))
+        runs = [('flash', bs, q) for bs in blockSizes for q in (0, uniflash.writeQueueDepth)]
+        runs += [('dump', bs, q) for bs in blockSizes for q in (1, 8)]
+        try:
+            with redirect_stdout(io.StringIO()):
+                session.connect()
+            for op, bs, q in runs:
+                with redirect_stdout(io.StringIO()):
+                    start = time.perf_counter()
+                    if op == 'flash':
+                        uniflash.writeQueueDepth = q
+                        session.write_flash_mem(imgName, 0, bs, True)
+                    else:
+                        session.read_partition(0x80000003, size, 0, outName, bs, q)
+                    elapsed = time.perf_counter() - start
+                if op == 'flash':
+                    assert dev.nor[:size] == img, 'Emulated flash contents do not match the image'
+                else:
+                    with open(outName, 'rb') as outf:
+                        assert outf.read() == img, 'Dump does not match the emulated flash contents'
+                print('%-8s %10d %8d %6d %6g %9.3f %9.2f' % (op, size, bs, q, latency, elapsed, size / elapsed / 1e6))
+                results.append({'bench': 'transfer', 'name': op, 'bytes': size, 'blockSize': bs, 'queueDepth': q, 'latencyMs': latency, 'seconds': elapsed, 'MBps': size / elapsed / 1e6})
+        finally:
+            session.close()
+            dev.close()
+
+# stone unpacking of synthetic images
+
+def bench_stone(size, results):
+    import stoned
+    cores = os.cpu_count() or 1
+    jobList = sorted(set([1 << i for i in range(cores.bit_length()) if 1 << i <= cores] + [cores])) # 1, 2, 4... and all cores
+    print('%-14s %10s %10s %5s %9s %9s' % ('function', 'image', 'unpacked', 'jobs', 'seconds', 'MB/s'))
+    with tempfile.TemporaryDirectory() as tmp:
+        imgName = os.path.join(tmp, 'stone.bin')
+        parts = synthetic_stone(imgName, size // 4, size // 8, size - size // 4 - size // 8)
+        total = sum(len(p) for p in parts.values())
+        imgSize = os.path.getsize(imgName)
+        for jobs in jobList:
+            with redirect_stdout(io.StringIO()):
+                start = time.perf_counter()
+                stoned.unpack_stone(imgName, tmp, jobs)
+                elapsed = time.perf_counter() - start
+            for name, data in parts.items():
+                with open(os.path.join(tmp, name), 'rb') as f:
+                    assert f.read() == data, '%s does not match after unpacking' % name
+            print('%-14s %10d %10d %5d %9.3f %9.2f' % ('unpack_stone', imgSize, total, jobs, elapsed, total / elapsed / 1e6))
+            results.append({'bench': 'stone', 'name': 'unpack_stone', 'bytes': imgSize, 'unpackedBytes': total, 'jobs': jobs, 'seconds': elapsed, 'MBps': total / elapsed / 1e6})
+        # repack the unpacked files and check they come out of the new image unchanged
+        packName = os.path.join(tmp, 'repacked.bin')
+        checkDir = os.path.join(tmp, 'check')
+        os.mkdir(checkDir)
+        for jobs in jobList:
+            with redirect_stdout(io.StringIO()):
+                stats = stoned.pack_stone(tmp, packName, jobs)
+                stoned.unpack_stone(packName, checkDir, 1)
+            for name, data in parts.items():
+                with open(os.path.join(checkDir, name), 'rb') as f:
+                    assert f.read() == data, '%s does not match after repacking' % name
+            elapsed = stats['seconds']
+            print('%-14s %10d %10d %5d %9.3f %9.2f' % ('pack_stone', stats['packedBytes'], total, jobs, elapsed, total / elapsed / 1e6))
+            results.append({'bench': 'stone', 'name': 'pack_stone', 'bytes': stats['packedBytes'], 'unpackedBytes': total, 'jobs': jobs, 'seconds': elapsed, 'MBps': total / elapsed / 1e6})
+
+# CLI startup
+
+STARTUP_COMMANDS = [
+    ('python', ['-c', 'pass']),
+    ('import uniflash', ['-c', 'import uniflash']),
+    ('uniflash -h', ['uniflash.py', '-h']),
+    ('import stoned', ['-c', 'import stoned'])
+]
+HEAVY_MODULES = ('usb', 'stoned', 'lzma', 'custlzma', 'hashlib', 'socket')
+
+def bench_startup(runs, results):
+    rootdir = os.path.dirname(os.path.realpath(__file__))
+    print('%-16s %9s %9s' % ('command', 'min ms', 'median ms'))
+    for name, cmd in STARTUP_COMMANDS:
+        times = []
+        for i in range(runs):
+            start = time.perf_counter()
+            subprocess.run([sys.executable] + cmd, cwd=rootdir, stdout=subprocess.DEVNULL, check=True)
+            times.append(time.perf_counter() - start)
+        times.sort()
+        print('%-16s %9.1f %9.1f' % (name, times[0] * 1e3, times[len(times) // 2] * 1e3))
+        results.append({'bench': 'startup', 'name': name, 'runs': runs, 'min': times[0], 'median': times[len(times) // 2]})
+    probe = 'import sys, uniflash; print(",".join(m for m in %r if m in sys.modules))' % (HEAVY_MODULES,)
+    loaded = subprocess.run([sys.executable, '-c', probe], cwd=rootdir, capture_output=True, text=True, check=True).stdout.strip()
+    print('Heavy modules loaded by import uniflash: %s' % (loaded or 'none'))
+    results.append({'bench': 'startup', 'name': 'heavy modules', 'loaded': loaded.split(',') if loaded else []})
+
+# main code start
+
+if __name__ == '__main__': # main app start
+    from argparse import ArgumentParser
+    parser = ArgumentParser(description='UniBench: benchmarks for the UniFlash checksum, HDLC codec, transfer and stone unpacking code', epilog='No rights reserved <https://unlicense.org>')
+    parser.add_argument('-s','--sizes', default='4096,65536,1048576', help='Comma-separated payload sizes in bytes (defaults to 4096,65536,1048576)')
+    parser.add_argument('-b','--benches', default='checksum,hdlc,transfer,stone,startup', help='Comma-separated benchmarks to run (defaults to checksum,hdlc,transfer,stone,startup)')
+    parser.add_argument('-ts','--transfer-size', type=lambda x: int(x, 0), default=0x200000, help='Image size for the flash/dump loops (defaults to 0x200000)')
+    parser.add_argument('-bs','--block-sizes', default='4096,32768', help='Comma-separated block sizes for the flash/dump loops (defaults to 4096,32768)')
+    parser.add_argument('-l','--latency', type=float, default=0, help='Reply latency of the emulated device in ms (defaults to 0, a plain loopback)')
+    parser.add_argument('-ss','--stone-size', type=lambda x: int(x, 0), default=0x400000, help='Unpacked size of the synthetic stone image (defaults to 0x400000)')
+    parser.add_argument('-sr','--startup-runs', type=int, default=10, help='Interpreter launches per command in the startup benchmark (defaults to 10)')
+    parser.add_argument('-o','--output', default=None, help='Write the results as JSON to this file')
+
+    args = parser.parse_args()
+
+    sizes = [int(x, 0) for x in args.sizes.split(',')]
+    benches = args.benches.split(',')
+    results = []
+    if 'checksum' in benches:
+        run_checks('ChecksumTest')
+        bench_checksums(sizes, results)
+    if 'hdlc' in benches:
+        run_checks('HdlcCodecTest')
+        bench_hdlc(sizes, results)
+    if 'transfer' in benches:
+        bench_transfer(args.transfer_size, [int(x, 0) for x in args.block_sizes.split(',')], args.latency, results)
+    if 'stone' in benches:
+        bench_stone(args.stone_size, results)
+    if 'startup' in benches:
+        bench_startup(args.startup_runs, results)
+    if args.output is not None:
+        report = {
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+            'python': sys.version.split()[0],
+            'platform': platform.platform(),
+            'results': results
+        }
+        with open(args.output, 'w') as outf:
+            json.dump(report, outf, indent=1)
+        print('Results written to %s' % args.output)
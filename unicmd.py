@@ -1,42 +1,28 @@
 # Command interface for Unisoc chipsets
 # Created by Luxferre in 2021
 
-from struct import pack, unpack
+from struct import pack, unpack_from
+from binascii import crc_hqx
 
 UNICMD_CRC_MISMATCH = 0xd00b
 
 # HDLC frame encoding/decoding (Unisoc modification)
 
-def crc16_xmodem(data: bytes): # xmodem used in boot mode 
-    crc = 0
-    data = bytearray(data)
-    msb = crc >> 8
-    lsb = crc & 255
-    for c in data:
-        x = (0xFF & c) ^ msb
-        x ^= (x >> 4)
-        msb = (lsb ^ (x >> 3) ^ (x << 4)) & 255
-        lsb = (x ^ (x << 5)) & 255
-    return (msb << 8) + lsb
+def crc16_xmodem(data: bytes): # xmodem used in boot mode
+    return crc_hqx(data, 0) # table-driven CRC-CCITT (XModem) from binascii
 
 def crc16_fdl(data: bytes): # used in FDL1/2 mode
-    crc = 0
-    data = bytearray(data)
+    # ones' complement sum of big-endian 16-bit words, odd trailing byte is added as is
     l = len(data)
-    for i in range(0,l,2):
-        if i+1 == l:
-            crc += data[i]
-        else:
-            crc += (data[i]<<8)|data[i+1]
+    crc = (sum(data[0:l&~1:2]) << 8) + sum(data[1::2])
+    if l & 1:
+        crc += data[l-1]
     crc = (crc >> 16) + (crc & 0xffff)
     crc += (crc >> 16)
     return ~crc & 0xffff
 
 def chksum32(data: bytes): # used in flashing mode
-    cksum = 0
-    for c in data:
-        cksum = (cksum + c) & 0xffffffff
-    return cksum
+    return sum(data) & 0xffffffff
 
 def hdlc_encode(data, fdl = False, nocrc = False):
     if nocrc:
@@ -46,34 +32,26 @@ def hdlc_encode(data, fdl = False, nocrc = False):
             crc = crc16_fdl(data)
         else:
             crc = crc16_xmodem(data)
-    out = []
-    rdata = bytearray(data + pack('>H', crc))
-    for c in rdata:
-        if c == 0x7e or c == 0x7d:
-            out.append(0x7d)
-            out.append(c ^ 0x20)
-        else:
-            out.append(c)
-    out = bytes(out)
-    return b'\x7e' + out + b'\x7e'
+    out = bytearray(b'\x7e')
+    out += data
+    out += pack('>H', crc)
+    if out.find(0x7d) >= 0 or out.find(0x7e, 1) >= 0: # escape in bulk (0x7d goes first), frames without escapes are left as is
+        out[1:] = out[1:].replace(b'\x7d', b'\x7d\x5d').replace(b'\x7e', b'\x7d\x5e')
+    out.append(0x7e)
+    return bytes(out)
 
 def hdlc_decode(data, fdl = False, ignoreCrc = False): # HDLC bug in Unisoc: CRC is also encoded!!!
-    rawdata = bytearray(data[1:-1])
-    out = []
-    esc = False
-    for c in rawdata:
-        if esc:
-            if c == 0x5e or c == 0x5d:
-                out.append(c ^ 0x20)
-                esc = False
-            else:
-                raise Exception("Invalid escape sequence while decoding HDLC frame")
-        elif c == 0x7d:
-            esc = True
-        else:
-            out.append(c)
-    decoded = bytes(out)
-    rawcrc = unpack('>H', decoded[-2:])[0]
+    if not isinstance(data, (bytes, bytearray)):
+        data = bytes(data)
+    l = len(data) - 1
+    if data.find(0x7d, 1, l) >= 0: # unescape in bulk
+        rawdata = data[1:l]
+        if rawdata.count(b'\x7d\x5e') + rawdata.count(b'\x7d\x5d') != rawdata.count(0x7d):
+            raise Exception("Invalid escape sequence while decoding HDLC frame")
+        decoded = memoryview(rawdata.replace(b'\x7d\x5e', b'\x7e').replace(b'\x7d\x5d', b'\x7d'))
+    else: # no escapes, just keep a view into the source buffer
+        decoded = memoryview(data)[1:l]
+    rawcrc = unpack_from('>H', decoded, len(decoded) - 2)[0]
     decoded = decoded[:-2]
     if fdl:
         calc_crc = crc16_fdl(decoded)
@@ -86,15 +64,68 @@ def hdlc_decode(data, fdl = False, ignoreCrc = False): # HDLC bug in Unisoc: CRC
         assert rawcrc == calc_crc, "Actual CRC16 value %04x does not match calculated value %04x after decoding HDLC frame" % (rawcrc, calc_crc)
     return decoded
 
-def resp_decode(data, fdl = False, ignoreCrc = False):
-    rawdata = hdlc_decode(data, fdl, ignoreCrc)
+def resp_parse(rawdata): # split an already decoded frame, content is a view into it
     if rawdata != UNICMD_CRC_MISMATCH:
-        respcode, resplen = unpack('>HH', rawdata[:4])
+        respcode, resplen = unpack_from('>HH', rawdata)
         content = rawdata[4:4+resplen]
         return respcode, resplen, content
     else:
         return UNICMD_CRC_MISMATCH, 0, None
 
+def resp_decode(data, fdl = False, ignoreCrc = False):
+    return resp_parse(hdlc_decode(data, fdl, ignoreCrc))
+
+# incremental HDLC frame parser for chunked (USB) reads
+
+class HdlcStream:
+    def __init__(self):
+        self.buf = bytearray() # reused across frames, consumed bytes are cut from the front
+        self.scanPos = 1 # where to continue looking for the closing flag
+
+    def reset(self):
+        del self.buf[:]
+        self.scanPos = 1
+
+    def pending(self):
+        return len(self.buf)
+
+    def feed(self, chunk):
+        self.buf += chunk
+
+    def next_raw(self): # complete raw frame with both flags or None if it hasn't arrived yet
+        buf = self.buf
+        start = buf.find(FLAG_BYTE)
+        if start < 0: # no frame start in the buffer, drop the noise
+            self.reset()
+            return None
+        if start > 0:
+            del buf[:start]
+            self.scanPos = 1
+        end = buf.find(FLAG_BYTE, self.scanPos)
+        while end == 1: # two flags in a row, the first one doesn't open anything
+            del buf[:1]
+            end = buf.find(FLAG_BYTE, 1)
+        if end < 0:
+            self.scanPos = len(buf)
+            return None
+        frame = bytes(buf[:end+1])
+        del buf[:end+1]
+        self.scanPos = 1
+        return frame
+
+    def next_frame(self, fdl = False, ignoreCrc = False): # decoded frame or None
+        frame = self.next_raw()
+        if frame is None:
+            return None
+        return hdlc_decode(frame, fdl, ignoreCrc)
+
+    def frames(self, fdl = False, ignoreCrc = False): # yield every decoded frame completed so far
+        while True:
+            frame = self.next_frame(fdl, ignoreCrc)
+            if frame is None:
+                return
+            yield frame
+
 # Unisoc command set constants
 
 FLAG_BYTE = 0x7E
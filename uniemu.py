@@ -0,0 +1,193 @@
+#!/usr/bin/env python
+# UniEmu - in-process emulated Unisoc device for hardware-free UniFlash runs
+# Released into public domain
+
+import os, time
+import mmap
+from collections import deque
+from struct import unpack_from
+import unicmd
+from unilink import TransportTimeout
+
+EMU_FLASH_BASE_ADDR = 0x10000000
+EMU_NOR_SIZE = 0x400000
+
+class EmulatedDevice:
+    # speaks the BootROM/FDL protocol against a NOR image kept in a file
+    # latency (s) is added to every reply, bandwidth (bytes/s, None for unlimited) is shared by all replies in order,
+    # maxPacketSize is the largest data payload the FDL accepts per MIDST_DATA/READ_FLASH frame
+    # like real NOR, flash writes only clear bits and ERASE_FLASH works on whole sectors of sectorSize
+    def __init__(self, norfile, latency = 0, bandwidth = None, maxPacketSize = 0x8000, sectorSize = 0x10000, flashBase = EMU_FLASH_BASE_ADDR, packetSize = 512):
+        if not os.path.exists(norfile): # start with a fully erased chip
+            with open(norfile, 'wb') as nf:
+                nf.write(b'\xff' * EMU_NOR_SIZE)
+        self.norfile = norfile
+        self.f = open(norfile, 'r+b')
+        self.nor = mmap.mmap(self.f.fileno(), 0)
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.maxPacketSize = maxPacketSize
+        self.sectorSize = sectorSize
+        self.flashBase = flashBase
+        self.packetSize = packetSize # USB IN endpoint packet size reported to the host
+        self.ram = {} # address -> data loaded with START/MIDST/END_DATA outside the flash range
+        self.stage = 'rom' # rom, then fdl once something is executed
+        self.attached = True
+        self.outq = deque() # (ready time, encoded reply)
+        self.rxParser = unicmd.HdlcStream()
+        self.busyUntil = 0 # when the replies queued so far are through the simulated link
+        self.download = None # state of the START_DATA transfer in progress
+        self.stats = {'frames': 0, 'bytesIn': 0, 'bytesOut': 0, 'erased': 0}
+
+    def close(self):
+        self.nor.close()
+        self.f.close()
+
+    # USB side
+
+    def attach(self): # (re-)enumeration on the bus
+        self.attached = True
+        self.outq.clear()
+        self.rxParser.reset()
+
+    def write(self, data):
+        assert self.attached, 'Emulated device is not on the bus'
+        self.stats['bytesIn'] += len(data)
+        self.rxParser.feed(data)
+        for frame in self.rxParser.frames(self.stage != 'rom'):
+            self.stats['frames'] += 1
+            self.handle(frame)
+
+    def read(self, buf, timeout):
+        # timeout is in ms like in PyUSB, waits for the reply in flight if there is one
+        if not self.outq:
+            raise TransportTimeout('Emulated device has no data to send')
+        ready, data = self.outq[0]
+        wait = ready - time.perf_counter()
+        if wait > 0:
+            if wait > timeout / 1000:
+                time.sleep(timeout / 1000)
+                raise TransportTimeout('Emulated device reply did not arrive in time')
+            time.sleep(wait)
+        n = min(len(buf), len(data))
+        buf[:n] = data[:n]
+        if n < len(data):
+            self.outq[0] = (ready, data[n:])
+        else:
+            self.outq.popleft()
+        self.stats['bytesOut'] += n
+        return n
+
+    def reply(self, code, payload = b''):
+        frame = unicmd.hdlc_encode(unicmd.shape_data_packet(code, payload), self.stage != 'rom')
+        now = time.perf_counter()
+        if self.bandwidth:
+            self.busyUntil = max(self.busyUntil, now) + len(frame) / self.bandwidth
+            ready = self.busyUntil + self.latency
+        else:
+            ready = now + self.latency
+        self.outq.append((ready, frame))
+
+    # protocol side
+
+    def flash_range(self, addr, size): # NOR offset of a flash address range or None if it's outside the chip
+        offset = addr - self.flashBase
+        if 0 <= offset and offset + size <= len(self.nor):
+            return offset
+        return None
+
+    def handle(self, frame):
+        if len(frame) < 4: # sync is just the flag byte in a 16-bit word
+            return self.reply(unicmd.BSL_REP_VER, b'SPRD3 EMU')
+        cmd, dlen = unpack_from('>HH', frame)
+        data = frame[4:]
+        if cmd in (unicmd.BSL_CMD_CONNECT, unicmd.BSL_CMD_CHANGE_BAUD, unicmd.BSL_CMD_ENABLE_WRITE_FLASH):
+            return self.reply(unicmd.BSL_REP_ACK)
+        if cmd == unicmd.BSL_CMD_START_DATA:
+            addr, size = unpack_from('>LL', data)
+            checksum = unpack_from('>L', data, 8)[0] if dlen >= 12 else None
+            offset = self.flash_range(addr, size)
+            # flash writes go straight to the chip, everything else is a RAM load kept until EXEC_DATA
+            self.download = {'addr': addr, 'size': size, 'checksum': checksum, 'offset': offset, 'done': 0, 'buf': bytearray() if offset is None else None}
+            return self.reply(unicmd.BSL_REP_ACK)
+        if cmd == unicmd.BSL_CMD_MIDST_DATA:
+            dl = self.download
+            if dl is None:
+                return self.reply(unicmd.BSL_REP_DOWN_NOT_START)
+            if dlen > self.maxPacketSize or dl['done'] + dlen > dl['size']:
+                return self.reply(unicmd.BSL_REP_DOWN_SIZE_ERROR)
+            if dl['buf'] is None: # programming NOR only clears bits, setting them back takes an erase
+                pos = dl['offset'] + dl['done']
+                self.nor[pos:pos+dlen] = (int.from_bytes(self.nor[pos:pos+dlen], 'big') & int.from_bytes(data, 'big')).to_bytes(dlen, 'big')
+            else:
+                dl['buf'] += data
+            dl['done'] += dlen
+            return self.reply(unicmd.BSL_REP_ACK)
+        if cmd == unicmd.BSL_CMD_END_DATA:
+            dl = self.download
+            if dl is None:
+                return self.reply(unicmd.BSL_REP_DOWN_NOT_START)
+            self.download = None
+            if dl['done'] != dl['size']:
+                return self.reply(unicmd.BSL_REP_DOWN_EARLY_END)
+            if dl['buf'] is not None:
+                if dl['checksum'] is not None and unicmd.chksum32(dl['buf']) != dl['checksum']:
+                    return self.reply(unicmd.BSL_REP_VERIFY_ERROR)
+                self.ram[dl['addr']] = bytes(dl['buf'])
+            return self.reply(unicmd.BSL_REP_ACK)
+        if cmd == unicmd.BSL_CMD_EXEC_DATA:
+            addr = unpack_from('>L', data)[0]
+            if addr not in self.ram:
+                return self.reply(unicmd.BSL_REP_DOWN_DEST_ERROR)
+            self.reply(unicmd.BSL_REP_ACK)
+            if self.stage == 'rom': # FDL1 takes over the USB port, the device re-enumerates
+                self.stage = 'fdl'
+                self.attached = False
+            return
+        if self.stage == 'rom': # the rest needs an FDL
+            return self.reply(unicmd.BSL_REP_INVALID_CMD)
+        if cmd == unicmd.BSL_CMD_READ_FLASH:
+            partid, size, offset = unpack_from('>LLL', data)
+            size = min(size, self.maxPacketSize, max(0, len(self.nor) - offset))
+            return self.reply(unicmd.BSL_REP_READ_FLASH, self.nor[offset:offset+size])
+        if cmd == unicmd.BSL_CMD_ERASE_FLASH:
+            addr, size = unpack_from('>LL', data)
+            offset = self.flash_range(addr, size)
+            if offset is None:
+                return self.reply(unicmd.BSL_REP_DOWN_DEST_ERROR)
+            # erase works on whole sectors, so an unaligned range takes the rest of its edge sectors with it
+            end = min(-(-(offset + size) // self.sectorSize) * self.sectorSize, len(self.nor))
+            offset -= offset % self.sectorSize
+            self.nor[offset:end] = b'\xff' * (end - offset)
+            self.stats['erased'] += end - offset
+            return self.reply(unicmd.BSL_REP_ACK)
+        if cmd == unicmd.BSL_CMD_READ_SECTOR_SIZE:
+            return self.reply(unicmd.BSL_REP_READ_SECTOR_SIZE, self.sectorSize.to_bytes(4, 'big'))
+        if cmd == unicmd.BSL_CMD_NORMAL_RESET:
+            self.reply(unicmd.BSL_REP_ACK)
+            self.stage = 'rom'
+            return
+        return self.reply(unicmd.BSL_REP_UNKNOWN_CMD)
+
+class EmuTransport: # UniFlash transport talking to an EmulatedDevice in the same process
+    def __init__(self, device):
+        self.device = device
+        self.packetSize = device.packetSize
+
+    def connect(self, poll = None):
+        self.device.attach()
+
+    def reconnect(self, poll = None):
+        self.device.attach()
+
+    def close(self):
+        pass
+
+    def write(self, data, timeout):
+        self.device.write(data)
+
+    def read(self, buf, timeout):
+        return self.device.read(buf, timeout)
+
+    def new_buffer(self, size):
+        return bytearray(size)
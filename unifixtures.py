@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+# UniFixtures - reference codecs and synthetic images shared by the tests and UniBench
+# Released into public domain
+
+import os
+import random
+import lzma
+from struct import pack
+
+# reference (byte-by-byte) implementations the fast ones must stay equivalent to
+
+def ref_crc16_xmodem(data):
+    msb = 0
+    lsb = 0
+    for c in bytearray(data):
+        x = (0xFF & c) ^ msb
+        x ^= (x >> 4)
+        msb = (lsb ^ (x >> 3) ^ (x << 4)) & 255
+        lsb = (x ^ (x << 5)) & 255
+    return (msb << 8) + lsb
+
+def ref_crc16_fdl(data):
+    crc = 0
+    data = bytearray(data)
+    l = len(data)
+    for i in range(0,l,2):
+        if i+1 == l:
+            crc += data[i]
+        else:
+            crc += (data[i]<<8)|data[i+1]
+    crc = (crc >> 16) + (crc & 0xffff)
+    crc += (crc >> 16)
+    return ~crc & 0xffff
+
+def ref_chksum32(data):
+    cksum = 0
+    for c in data:
+        cksum = (cksum + c) & 0xffffffff
+    return cksum
+
+def ref_hdlc_encode(data, fdl = False):
+    crc = ref_crc16_fdl(data) if fdl else ref_crc16_xmodem(data)
+    out = []
+    for c in bytearray(bytes(data) + crc.to_bytes(2, 'big')):
+        if c == 0x7e or c == 0x7d:
+            out.append(0x7d)
+            out.append(c ^ 0x20)
+        else:
+            out.append(c)
+    return b'\x7e' + bytes(out) + b'\x7e'
+
+def ref_hdlc_decode(data, fdl = False):
+    out = []
+    esc = False
+    for c in bytearray(data[1:-1]):
+        if esc:
+            assert c == 0x5e or c == 0x5d
+            out.append(c ^ 0x20)
+            esc = False
+        elif c == 0x7d:
+            esc = True
+        else:
+            out.append(c)
+    decoded = bytes(out)
+    crc = ref_crc16_fdl(decoded[:-2]) if fdl else ref_crc16_xmodem(decoded[:-2])
+    assert crc == int.from_bytes(decoded[-2:], 'big')
+    return decoded[:-2]
+
+def escaped_payload(size, density):
+    # random payload where roughly the given share of bytes needs HDLC escaping
+    data = bytearray(os.urandom(size).replace(b'\x7e', b'\x00').replace(b'\x7d', b'\x00'))
+    step = int(1 / density) if density > 0 else 0
+    if step:
+        data[::step] = b'\x7e' * len(data[::step])
+    return bytes(data)
+
+# synthetic stone images
+
+def synthetic_payload(rng, size): # compresses to about a half like real firmware code does
+    return rng.randbytes((size + 1) // 2).hex().encode()[:size]
+
+def capn_block(data, chunkSize):
+    # CAPN multi-block payload of FORMAT_ALONE LZMA streams, returns (block data, blkPacSize)
+    # every stream is followed by 0xFF padding up to the 2 * blkPacSize window unpack_block reads
+    streams = [lzma.compress(data[pos:pos+chunkSize], format=lzma.FORMAT_ALONE) for pos in range(0, len(data), chunkSize)]
+    pacSize = (max(len(s) for s in streams) + 1) // 2
+    window = pacSize * 2
+    tblSize = len(streams) * 4
+    out = bytearray(pack('<LLLL', 0x4E504143, 0, 16, len(streams))) # offset table right after the header
+    out += b''.join(pack('<L', 16 + tblSize + i * window) for i in range(len(streams)))
+    for s in streams:
+        out += s + b'\xff' * (window - len(s))
+    return bytes(out), pacSize
+
+def bzp_section(magic, blocks, chunkSize, secType = 0):
+    # DRPS/RRPS section with COLB headers for the given (block id, data) list
+    hdrSize = 16 + len(blocks) * 20
+    blkHdrs = bytearray()
+    blkData = bytearray()
+    for blkId, data in blocks:
+        payload, pacSize = capn_block(data, chunkSize)
+        blkHdrs += pack('<LLLLL', 0x424C4F43, blkId, hdrSize + len(blkData), len(payload), pacSize)
+        blkData += payload
+    return pack('<LLLL', magic, secType, 16, len(blocks)) + blkHdrs + blkData
+
+def synthetic_stone(fname, kernSize, userSize, rsrcSize, chunkSize = 0x10000, seed = 0, sectionTypes = (0, 0)):
+    # PS image with the TRAPGAMI table, then a DRPS section with kern/user and an RRPS one with rsrc
+    rng = random.Random(seed)
+    parts = {'kern.bin': synthetic_payload(rng, kernSize), 'user.bin': synthetic_payload(rng, userSize), 'rsrc.bin': synthetic_payload(rng, rsrcSize)}
+    sections = [bzp_section(0x53505244, [(0x494D4147, parts['kern.bin']), (0x75736572, parts['user.bin'])], chunkSize, sectionTypes[0]),
+        bzp_section(0x53505252, [(0x7253736F, parts['rsrc.bin'])], chunkSize, sectionTypes[1])]
+    ps = bytearray(rng.randbytes(0x10000))
+    addr = len(ps)
+    table = []
+    for section in sections:
+        table.append(addr)
+        addr += (len(section) + 0xfff) & ~0xfff
+    table += [0xffffffff] * (28 - len(table))
+    ps[0x100:0x100+120] = b'TRAPGAMI' + pack('<28L', *table)
+    parts['ps.bin'] = bytes(ps)
+    with open(fname, 'wb') as f:
+        f.write(ps)
+        for section in sections:
+            f.write(section + b'\xff' * (-len(section) & 0xfff))
+    return parts
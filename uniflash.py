@@ -1,10 +1,16 @@
 #!/usr/bin/env python
 
-import usb
 import sys, time
 import os
+import threading, queue
+import mmap
+import functools
+import json
+from collections import deque
+from struct import unpack
 import unicmd
-import stoned
+import unilink
+import unitrace
 
 # global params
 
@@ -13,146 +19,928 @@ UNISOC_PID = 0x4d00
 UNISOC_FLASH_BASE_ADDR = 0x10000000
 UNISOC_FLASH_BASE_ADDR_OLD = 0x30000000
 MAX_PKT_SIZE = 1024
-bSize = 512 # read block size
 genTimeout = 120000
+writeQueueDepth = 8 # data frames encoded ahead while waiting for ACKs, 0 means lock-step transfer
+readQueueDepth = 1 # READ_FLASH requests kept outstanding on dumps
+probeTimeout = 3000 # how long to wait for queued replies before deciding the FDL doesn't support them
+journalInterval = 0x40000 # how often the dump journal gets updated, in bytes
+targetName = 'sc6531efm_generic' # what tuned parameters are cached for
+autoBlockSize = False # tune the block size on the first part of every transfer
+blockSizeCandidates = (4096, 8192, 16384, 32768) # tried in this order by --auto-block-size, packet lengths are 16-bit
+tuneProbeSize = 0x20000 # bytes moved with every candidate block size
+defaultSectorSize = 0x10000 # used for sparse flashing when the FDL can't tell the sector size
+verifyRetries = 1 # how many times mismatching sectors get re-flashed after verification
 
-# all main procedures
+# local cache for tuned parameters
 
-def connect(vid, pid):
-    while True:
-        dev = usb.core.find(idVendor=vid, idProduct=pid)
-        sys.stdout.write('.')
-        sys.stdout.flush()
-        if dev is not None:
-            print('\nDevice connected')
-            break
-        time.sleep(0.1)
-    dev.set_configuration()
-    cfg = dev.get_active_configuration()
-    intf = cfg[(0,0)]
-    global bSize
-    bSize = intf[0].wMaxPacketSize
-    epIn = usb.util.find_descriptor(
-        intf,
-        custom_match = \
-        lambda e: \
-            usb.util.endpoint_direction(e.bEndpointAddress) == \
-            usb.util.ENDPOINT_IN)
-    epOut = usb.util.find_descriptor(
-        intf,
-        custom_match = \
-        lambda e: \
-            usb.util.endpoint_direction(e.bEndpointAddress) == \
-            usb.util.ENDPOINT_OUT)
-    assert epIn is not None
-    assert epOut is not None
-    return dev, epIn, epOut
-
-
-def reqonly(packet, fdlBooted = False, noCrc = False):
-    packet = unicmd.hdlc_encode(packet, fdlBooted, noCrc)
-    dev.write(epOut, packet, genTimeout)
-
-def reqresp(packet, fdlBooted = False, noCrc = False):
-    reqonly(packet, fdlBooted, noCrc)
-    resp = bytes(dev.read(epIn, bSize, genTimeout))
-    return resp
-
-def handshake(fdlBooted = False):
-    resp = reqresp(unicmd.cmd_sync(), fdlBooted)
-    rcode, rlen, r = unicmd.resp_decode(resp, fdlBooted)
-    if len(r):
-        print('>', r.decode())
-    resp = reqresp(unicmd.cmd_connect(), fdlBooted)
-    rcode, rlen, r = unicmd.resp_decode(resp, fdlBooted)
-    if len(r):
-        print('>', r.decode())
-
-def send_file_to_addr(fname, faddr, fdlBooted = False, flashMode = False, fbs = 1024):
-    pSize = MAX_PKT_SIZE
-    print('Initializing data transfer...')
-    dataCrc = 0
-    if flashMode:
-        # faddr is our flash offset in this case, and we directly pass the data buffer to the function
-        pSize = fbs
-        fdata = fname
-        flen = len(fdata)
-    else:
-        f = open(fname, 'rb')
+cacheLock = threading.Lock() # station sessions share the cache files
+
+# the cache is best-effort: when it can't be read or written everything is worked out again, never fails the flashing
+
+def cache_path(name):
+    cacheDir = os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'), 'uniflash')
+    os.makedirs(cacheDir, exist_ok=True)
+    return os.path.join(cacheDir, name)
+
+def load_cache(name):
+    try:
+        with open(cache_path(name)) as cf:
+            return json.load(cf)
+    except (OSError, ValueError):
+        return {}
+
+def write_cache_file(name, data):
+    # every writer gets a temp file of its own, station threads may store the same entry at once
+    import tempfile # pulls in shutil and through it lzma and bz2, so only when the cache gets written
+    cpath = cache_path(name)
+    fd, tmpPath = tempfile.mkstemp(dir=os.path.dirname(cpath), prefix=name + '.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as cf:
+            cf.write(data)
+        os.replace(tmpPath, cpath)
+    except OSError:
+        try:
+            os.unlink(tmpPath)
+        except OSError:
+            pass
+        raise
+
+def save_cache(name, data):
+    try:
+        write_cache_file(name, json.dumps(data, indent=1).encode())
+    except OSError:
+        pass
+
+# FDL target manifest: targets and FDL file digests, rebuilt when anything under fdls/ changes
+
+def fdl_digest(fname): # what the manifest keeps about an FDL file
+    import hashlib
+    with open(fname, 'rb') as f:
         fdata = f.read()
-        f.close()
-        flen = len(fdata)
-        dataCrc = unicmd.chksum32(fdata)
-    resp = reqresp(unicmd.cmd_data_start(faddr, flen, dataCrc), fdlBooted)
-    rcode, rlen, r = unicmd.resp_decode(resp, fdlBooted)
-    assert rcode == unicmd.BSL_REP_ACK, 'Could not start data transfer, response code is %X' % rcode
-    if rcode == unicmd.BSL_REP_LOG:
-        print(r)
-    print('Starting data transfer...')
-    while fdata:
-        buf = fdata[:pSize]
-        resp = reqresp(unicmd.cmd_data_send(buf), fdlBooted)
-        rcode, rlen, r = unicmd.resp_decode(resp, fdlBooted)
-        assert rcode == unicmd.BSL_REP_ACK, 'Something is wrong and response code is %X, block is %s' % (rcode, buf.hex())
-        fdata = fdata[pSize:]
-        sys.stdout.write('.')
-        sys.stdout.flush()
-    print('\nEnding data transfer...')
-    resp = reqresp(unicmd.cmd_data_end(), fdlBooted)
-    rcode, rlen, r = unicmd.resp_decode(resp, fdlBooted)
-    if not flashMode or (rcode != unicmd.BSL_FLASH_CFG_ERROR and rcode != unicmd.BSL_WRITE_ERROR and rcode != 0xFF): # on flashing, ignore 0xA2, 0xA4 and 0xFF errors
-        assert rcode == unicmd.BSL_REP_ACK, 'Could not finalize data transfer, response code is %X' % rcode
-    print('Data transfer successful')
-
-# readback code implementation
-
-def read_partdata(partid, size, offset):
-    t = b''
-    reqonly(unicmd.cmd_read_flash(partid, size, offset), True)
-    while True:
-        xr = bytes(dev.read(epIn, bSize, genTimeout))
-        t += xr
-        if len(xr) < bSize:
-            break
-    return t
-
-def read_partition(partid, partsize, partoffset, outfile, rbblocksize):
-    outf = open(outfile, 'wb')
-    psize = partsize
-    offset = partoffset
-    print('Dumping %d bytes from partition 0x%X at offset 0x%X to %s...' % (partsize, partid, partoffset, outfile))
-    bufsize = rbblocksize
-    while psize > 0:
-        if psize < bufsize:
-            bufsize = psize
-        resp = read_partdata(partid, bufsize, offset)
-        rcode, rlen, r = unicmd.resp_decode(resp, True)
-        outf.write(r)
-        sys.stdout.write('.')
-        sys.stdout.flush()
-        psize -= rlen
-        offset += rlen
+    st = os.stat(fname)
+    return {'mtime': st.st_mtime_ns, 'size': st.st_size, 'sha1': hashlib.sha1(fdata).hexdigest(), 'checksum': unicmd.chksum32(fdata)}
+
+def scan_fdls(fdlDir):
+    # FDL file names are <target>_<load address>_<single/fdl1/fdl2>.bin
+    dirs = {}
+    targets = {}
+    for root, subdirs, files in os.walk(fdlDir):
+        dirs[root] = os.stat(root).st_mtime_ns
+        for name in files:
+            params = os.path.splitext(name)[0].rsplit('_', 2)
+            if len(params) == 3:
+                targets.setdefault(params[0], {})[params[2]] = [os.path.join(root, name), params[1]]
+    return dirs, targets
+
+def load_manifest(fdlDir):
+    manifest = load_cache('fdls.json')
+    dirs = manifest.get('dirs', {})
+    try:
+        valid = manifest.get('fdlDir') == fdlDir and all(os.stat(d).st_mtime_ns == mtime for d, mtime in dirs.items())
+    except OSError:
+        valid = False
+    if not valid:
+        dirs, targets = scan_fdls(fdlDir)
+        manifest = {'fdlDir': fdlDir, 'dirs': dirs, 'targets': targets, 'files': {}}
+        save_cache('fdls.json', manifest)
+    return manifest
+
+def load_targets(fdlDir): # {target: {tag: [path, load address]}}
+    with cacheLock:
+        return load_manifest(fdlDir)['targets']
+
+def fdl_info(fname): # digest of an FDL file from the manifest, updated if the file changed
+    path = os.path.realpath(fname)
+    with cacheLock:
+        manifest = load_cache('fdls.json')
+        files = manifest.setdefault('files', {})
+        info = files.get(path)
+        st = os.stat(path)
+        if info is None or info['mtime'] != st.st_mtime_ns or info['size'] != st.st_size:
+            info = files[path] = fdl_digest(path)
+            save_cache('fdls.json', manifest)
+    return info
+
+class FdlFrames: # pre-encoded MIDST_DATA frames of an FDL upload
+    def __init__(self, info, pSize, data):
+        self.size = info['size']
+        self.checksum = info['checksum']
+        self.pSize = pSize
+        self.data = data # all frames back to back, every one starts and ends with the flag byte
+
+    def frames(self): # yields (payload size, frame) like data_frames
+        data = memoryview(self.data)
+        pos = 0
+        left = self.size
+        while left > 0:
+            end = self.data.find(unicmd.FLAG_BYTE, pos + 1) + 1
+            yield min(left, self.pSize), data[pos:end]
+            left -= self.pSize
+            pos = end
+
+def fdl_frames(fname, pSize, fdlBooted = False):
+    # the frames only depend on the file contents, chunk size and CRC mode, so they're encoded once and kept in the cache
+    info = fdl_info(fname)
+    cname = 'fdl-%s-%d-%s.frames' % (info['sha1'], pSize, 'fdl' if fdlBooted else 'rom')
+    try:
+        with open(cache_path(cname), 'rb') as cf:
+            data = cf.read()
+        if data.count(unicmd.FLAG_BYTE) == 2 * ((info['size'] + pSize - 1) // pSize):
+            return FdlFrames(info, pSize, data)
+    except OSError:
+        pass
+    with ImageSource(fname) as src:
+        data = b''.join(frame for size, frame in data_frames(src.data, pSize, fdlBooted))
+    try:
+        write_cache_file(cname, data)
+    except OSError:
+        pass
+    return FdlFrames(info, pSize, data)
+
+# input images
+
+class ImageSource: # read-only window into a file, mapped instead of read so that chunks are zero-copy views
+    def __init__(self, fname, offset = 0, length = None):
+        self.name = fname
+        self.f = open(fname, 'rb')
+        fsize = os.fstat(self.f.fileno()).st_size
+        if length is None:
+            length = fsize - offset
+        assert 0 <= offset and offset + length <= fsize, 'Range 0x%X+0x%X is out of bounds of %s (%d bytes)' % (offset, length, fname, fsize)
+        self.mm = None
+        if fsize > 0: # empty files can't be mapped
+            self.mm = mmap.mmap(self.f.fileno(), 0, access=mmap.ACCESS_READ)
+            self.data = memoryview(self.mm)[offset:offset+length]
+        else:
+            self.data = memoryview(b'')
+
+    def __len__(self):
+        return len(self.data)
+
+    def close(self):
+        self.data.release()
+        if self.mm is not None:
+            try:
+                self.mm.close()
+            except BufferError: # a view is still alive (e.g. in a traceback), the mapping goes away with it
+                pass
+        self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def open_image(fname, offset = 0, length = None): # ImageSource, or a SparseSource for dump containers made with --dump-compress
+    import unisparse
+    if unisparse.is_container(fname):
+        return unisparse.SparseSource(fname, offset, length)
+    return ImageSource(fname, offset, length)
+
+# data transfer helpers
+
+def data_frames(fdata, pSize, fdlBooted = False): # yields (payload size, encoded MIDST_DATA frame)
+    for pos in range(0, len(fdata), pSize):
+        buf = fdata[pos:pos+pSize]
+        yield len(buf), unicmd.hdlc_encode(unicmd.cmd_data_send(buf), fdlBooted)
+
+def prefetch(items, depth): # run a generator in a producer thread, up to depth items ahead of the consumer
+    q = queue.Queue(depth)
+    done = object()
+    cancelled = threading.Event()
+    def put(entry): # False once the consumer is gone, nobody would take the entry off a full queue
+        while not cancelled.is_set():
+            try:
+                q.put(entry, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+    def produce():
+        try:
+            for item in items:
+                if not put((item, None)):
+                    return
+            put((done, None))
+        except BaseException as e:
+            put((done, e))
+    producer = threading.Thread(target=produce, daemon=True)
+    producer.start()
+    try:
+        while True:
+            item, err = q.get()
+            if err is not None:
+                raise err
+            if item is done:
+                break
+            yield item
+    finally:
+        cancelled.set()
+        producer.join()
+
+# dump journal: a sidecar file that tells how much of the dump is already on disk
+
+def journal_path(outfile):
+    return outfile + '.journal'
+
+def write_journal(outfile, journal):
+    jpath = journal_path(outfile)
+    with open(jpath + '.tmp', 'w') as jf:
+        json.dump(journal, jf)
+    os.replace(jpath + '.tmp', jpath)
+
+def checkpoint(outf, outfile, journal, done, h): # journal only what has reached the file
     outf.flush()
-    print('\nPartition dumped!')
-
-# memory eraser and writer
-
-def erase_flash_mem(size, faddr):
-    print('Erasing %d bytes in the flash memory at offset 0x%X...' % (size, faddr - UNISOC_FLASH_BASE_ADDR))
-    resp = reqresp(unicmd.cmd_erase_flash(faddr, size), True)
-    rcode, rlen, r = unicmd.resp_decode(resp, True)
-    assert rcode == unicmd.BSL_REP_ACK, 'Could not erase flash memory, response code is %X' % rcode
-    print('Flash range erased!')
-
-def write_flash_mem(infile, offset, blocksize, forceErase):
-    startAddr = UNISOC_FLASH_BASE_ADDR + offset
-    f = open(infile, 'rb')
-    fdata = f.read()
-    f.close()
+    journal['done'] = done
+    journal['sha1'] = h.hexdigest()
+    write_journal(outfile, journal)
+
+# flash sector bookkeeping
+
+def sector_runs(sectors, flen, offset, sectorSize):
+    # turn sorted sector indexes into merged (start, end) ranges of an image of flen bytes at flash offset
+    runs = []
+    for idx in sectors:
+        start = max(0, idx * sectorSize - offset)
+        end = min(flen, (idx + 1) * sectorSize - offset)
+        if runs and runs[-1][1] == start:
+            runs[-1] = (runs[-1][0], end)
+        else:
+            runs.append((start, end))
+    return runs
+
+def dirty_runs(fdata, offset, sectorSize):
+    # ranges of fdata made of whole flash sectors that hold anything but 0xFF
+    sectors = []
     flen = len(fdata)
-    if forceErase:
-        erase_flash_mem(flen, startAddr)
-    send_file_to_addr(fdata, startAddr, True, True, blocksize)
+    for idx in range(offset // sectorSize, (offset + flen + sectorSize - 1) // sectorSize):
+        start = max(0, idx * sectorSize - offset)
+        end = min(flen, (idx + 1) * sectorSize - offset)
+        if fdata[start:end].tobytes() != b'\xff' * (end - start): # memoryview comparison would go byte by byte
+            sectors.append(idx)
+    return sector_runs(sectors, flen, offset, sectorSize)
+
+# device session: everything needed to talk to a single device
+
+class ProbeShort(Exception): # the transfer is too small to try a block size on
+    pass
+
+def traced(name, detail = None):
+    # run a session method as a trace phase, detail(*args) describes the call, re-entrant calls stay in the same phase
+    def wrap(fn):
+        @functools.wraps(fn)
+        def run(self, *args, **kwargs):
+            if self.trace.open and self.trace.open[-1]['name'] == name:
+                return fn(self, *args, **kwargs)
+            with self.trace.phase(name, detail(*args) if detail else None):
+                return fn(self, *args, **kwargs)
+        return run
+    return wrap
+
+class UniSession:
+    def __init__(self, link, label = None):
+        self.link = link # transport to the device, see unilink
+        self.label = label # log prefix
+        self.bSize = 512 # read block size
+        self.rxParser = unicmd.HdlcStream() # incoming frame parser
+        self.rxBufs = {} # reusable USB read buffers by size
+        self.moved = 0 # payload bytes transferred in either direction
+        self.trace = unitrace.Trace()
+        self.status = 'waiting'
+        self.blockSizes = {} # direction -> block size settled by --auto-block-size in this session
+
+    # logging
+
+    def log(self, msg):
+        if self.label is not None:
+            print('[%s] %s' % (self.label, msg))
+        else:
+            print(msg)
+
+    def progress(self, nbytes):
+        self.moved += nbytes
+        self.trace.add_bytes(nbytes)
+
+    def report(self): # phase summary of the whole session
+        for line in self.trace.summary():
+            self.log(line)
+
+    # device connection
+
+    def poll(self): # called while waiting for the device
+        self.trace.retry('connect poll')
+
+    def connected(self):
+        self.log('Device connected')
+        self.bSize = self.link.packetSize
+        self.rxParser.reset()
+
+    @traced('connect')
+    def connect(self):
+        self.link.connect(self.poll)
+        self.connected()
+
+    @traced('reconnect')
+    def reconnect(self): # the device re-enumerates after FDL1 starts
+        startTime = time.perf_counter()
+        self.link.reconnect(self.poll)
+        self.connected()
+        self.log('Reconnected in %.3f s' % (time.perf_counter() - startTime))
+
+    def close(self):
+        self.link.close()
+
+    # request/response primitives
+
+    def reqonly(self, packet, fdlBooted = False, noCrc = False):
+        packet = unicmd.hdlc_encode(packet, fdlBooted, noCrc)
+        self.link.write(packet, genTimeout)
+
+    def readresp(self, fdlBooted = False, expect = 0, timeout = genTimeout):
+        # read USB chunks until a complete frame arrives, expect is the minimum frame size if known
+        frame = self.rxParser.next_frame(fdlBooted)
+        while frame is None:
+            # only ask for whole packets that are sure to come, so a frame ending on a packet boundary can't stall the read
+            rsize = max(self.bSize, (expect - self.rxParser.pending()) // self.bSize * self.bSize)
+            rbuf = self.rxBufs.get(rsize)
+            if rbuf is None:
+                rbuf = self.rxBufs[rsize] = self.link.new_buffer(rsize)
+            rlen = self.link.read(rbuf, timeout)
+            self.rxParser.feed(memoryview(rbuf)[:rlen])
+            frame = self.rxParser.next_frame(fdlBooted)
+        return frame
+
+    def drain_input(self, timeout = 200): # discard everything the device still has to say
+        rbuf = self.link.new_buffer(self.bSize)
+        try:
+            while True:
+                self.link.read(rbuf, timeout)
+        except unilink.TransportTimeout:
+            pass
+        self.rxParser.reset()
+
+    def reqframe(self, frame): # send an already encoded frame
+        self.link.write(frame, genTimeout)
+
+    def reqresp(self, packet, fdlBooted = False, noCrc = False):
+        sent = time.perf_counter()
+        self.reqonly(packet, fdlBooted, noCrc)
+        resp = self.readresp(fdlBooted)
+        self.trace.rtt('command', time.perf_counter() - sent)
+        return resp
+
+    @traced('handshake')
+    def handshake(self, fdlBooted = False):
+        resp = self.reqresp(unicmd.cmd_sync(), fdlBooted)
+        rcode, rlen, r = unicmd.resp_parse(resp)
+        if len(r):
+            self.log('> ' + bytes(r).decode())
+        resp = self.reqresp(unicmd.cmd_connect(), fdlBooted)
+        rcode, rlen, r = unicmd.resp_parse(resp)
+        if len(r):
+            self.log('> ' + bytes(r).decode())
+
+    # block size tuning
+
+    def pick_block_size(self, direction, probe, fallback):
+        # probe(bs) moves tuneProbeSize bytes with the block size bs and returns the seconds it took, or None if the device rejected bs
+        # it raises ProbeShort if the transfer has too little data left for that, probing then waits for a bigger transfer
+        # the block size is settled once per session, later transfers just reuse it
+        if direction in self.blockSizes:
+            return self.blockSizes[direction]
+        key = '%s/%s' % (targetName, direction)
+        with cacheLock:
+            cached = load_cache('blocksize.json')
+        if key in cached:
+            self.log('Using cached %s block size %d for %s' % (direction, cached[key], targetName))
+            self.blockSizes[direction] = cached[key]
+            return cached[key]
+        best = None
+        bestRate = 0
+        complete = True
+        for bs in blockSizeCandidates:
+            try:
+                elapsed = probe(bs)
+            except ProbeShort:
+                complete = False
+                break
+            if bs == blockSizeCandidates[0]:
+                self.log('Probing %s block sizes...' % direction)
+            if elapsed is None:
+                self.log('Block size %d: not supported' % bs)
+                self.trace.retry('block size probe rejected')
+                break
+            rate = tuneProbeSize / max(elapsed, 1e-9) / 1e6
+            self.log('Block size %d: %.2f MB/s' % (bs, rate))
+            if rate > bestRate:
+                best, bestRate = bs, rate
+        if best is None:
+            if complete:
+                self.log('Could not tune the %s block size, keeping %d' % (direction, fallback))
+                self.blockSizes[direction] = fallback
+            return fallback
+        self.log('Locked in %s block size %d' % (direction, best))
+        self.blockSizes[direction] = best
+        if complete: # a probe cut short by the end of the data is good for this session only
+            with cacheLock:
+                cached = load_cache('blocksize.json')
+                cached[key] = best
+                save_cache('blocksize.json', cached)
+        return best
+
+    def tune_read_block_size(self, partid, offset, length, fallback):
+        # reads are side-effect free, so the probes are simply thrown away
+        def probe(bs):
+            if length < tuneProbeSize:
+                raise ProbeShort()
+            probeStart = time.perf_counter()
+            try:
+                for chunk in range(offset, offset + tuneProbeSize, bs):
+                    rcode, rlen, r = unicmd.resp_parse(self.read_partdata(partid, bs, chunk))
+                    if rlen != bs:
+                        return None
+            except (unilink.TransportTimeout, AssertionError):
+                self.drain_input()
+                return None
+            return time.perf_counter() - probeStart
+        return self.pick_block_size('read', probe, fallback)
+
+    # data transfer implementation
+
+    def send_data_frame(self, buf, fdlBooted = False): # lock-step MIDST_DATA, returns the response code
+        sent = time.perf_counter()
+        self.reqframe(unicmd.hdlc_encode(unicmd.cmd_data_send(buf), fdlBooted))
+        rcode, rlen, r = unicmd.resp_parse(self.readresp(fdlBooted))
+        self.trace.rtt('write', time.perf_counter() - sent)
+        return rcode
+
+    @traced('send_file_to_addr', lambda src, faddr, *args: '0x%X' % faddr)
+    def send_file_to_addr(self, src, faddr, fdlBooted = False, flashMode = False, fbs = 1024):
+        # src is a file name or a buffer (like an ImageSource view), faddr is our flash offset in flash mode
+        # files sent outside flash mode are FDLs, their frames come from the cache
+        cached = None
+        if isinstance(src, str):
+            if flashMode:
+                with open_image(src) as fsrc:
+                    return self.send_file_to_addr(fsrc.data, faddr, fdlBooted, flashMode, fbs)
+            cached = fdl_frames(src, MAX_PKT_SIZE, fdlBooted)
+        pSize = MAX_PKT_SIZE
+        self.log('Initializing data transfer...')
+        dataCrc = 0
+        fdata = src
+        if cached is not None:
+            flen = cached.size
+            dataCrc = cached.checksum
+        else:
+            flen = len(fdata)
+            if flashMode:
+                pSize = fbs
+            else:
+                dataCrc = unicmd.chksum32(fdata)
+        resp = self.reqresp(unicmd.cmd_data_start(faddr, flen, dataCrc), fdlBooted)
+        rcode, rlen, r = unicmd.resp_parse(resp)
+        assert rcode == unicmd.BSL_REP_ACK, 'Could not start data transfer, response code is %X' % rcode
+        if rcode == unicmd.BSL_REP_LOG:
+            self.log(r)
+        self.log('Starting data transfer...')
+        startTime = time.perf_counter()
+        pos = 0
+        if flashMode and autoBlockSize: # try the candidate block sizes on the first part of the data
+            def probe(bs):
+                nonlocal pos
+                if flen - pos < tuneProbeSize:
+                    raise ProbeShort()
+                probeStart = time.perf_counter()
+                for chunk in range(pos, pos + tuneProbeSize, bs):
+                    if self.send_data_frame(fdata[chunk:chunk+bs], fdlBooted) != unicmd.BSL_REP_ACK:
+                        return None # rejected chunk is sent again with the final block size
+                    pos = chunk + bs
+                    self.progress(bs)
+                return time.perf_counter() - probeStart
+            pSize = self.pick_block_size('write', probe, fbs)
+        if cached is not None:
+            frames = cached.frames()
+        else:
+            frames = data_frames(fdata[pos:], pSize, fdlBooted)
+            if writeQueueDepth > 0: # encode the next frames while we're waiting for the device
+                frames = prefetch(frames, writeQueueDepth)
+        try:
+            for size, frame in frames:
+                sent = time.perf_counter()
+                self.reqframe(frame)
+                resp = self.readresp(fdlBooted)
+                self.trace.rtt('write', time.perf_counter() - sent)
+                rcode, rlen, r = unicmd.resp_parse(resp)
+                assert rcode == unicmd.BSL_REP_ACK, 'Something is wrong and response code is %X at offset 0x%X' % (rcode, pos)
+                self.progress(size)
+                pos += size
+        finally:
+            frames.close() # stops the producer thread if we bail out early
+        elapsed = time.perf_counter() - startTime
+        self.log('%d bytes sent in %.2f s (%.2f MB/s)' % (flen, elapsed, flen / max(elapsed, 1e-9) / 1e6))
+        self.log('Ending data transfer...')
+        resp = self.reqresp(unicmd.cmd_data_end(), fdlBooted)
+        rcode, rlen, r = unicmd.resp_parse(resp)
+        if not flashMode or (rcode != unicmd.BSL_FLASH_CFG_ERROR and rcode != unicmd.BSL_WRITE_ERROR and rcode != 0xFF): # on flashing, ignore 0xA2, 0xA4 and 0xFF errors
+            assert rcode == unicmd.BSL_REP_ACK, 'Could not finalize data transfer, response code is %X' % rcode
+        self.log('Data transfer successful')
+
+    # readback code implementation
+
+    def read_partdata(self, partid, size, offset):
+        sent = time.perf_counter()
+        self.reqonly(unicmd.cmd_read_flash(partid, size, offset), True)
+        resp = self.readresp(True, size + 10) # flags, header and CRC around the data
+        self.trace.rtt('read', time.perf_counter() - sent)
+        return resp
+
+    def read_blocks(self, partid, startOffset, endOffset, rbblocksize, depth = None):
+        # yields (offset, data) for consecutive blocks of the partition, data is only valid until the next block
+        if depth is None:
+            depth = readQueueDepth
+        offset = startOffset # next offset to be handed out
+        reqOffset = startOffset # next offset to be requested
+        pending = deque() # (offset, size, send time) of the requests sent but not answered yet, in order
+        probing = depth > 1 # the first window is sent at once and must be answered in full before we keep the queue topped up
+        if depth > 1:
+            self.log('Keeping up to %d read requests in flight' % depth)
+        while offset < endOffset:
+            if not probing or reqOffset == startOffset: # while probing, only the first window goes out
+                while len(pending) < depth and reqOffset < endOffset:
+                    bufsize = min(rbblocksize, endOffset - reqOffset)
+                    self.reqonly(unicmd.cmd_read_flash(partid, bufsize, reqOffset), True)
+                    pending.append((reqOffset, bufsize, time.perf_counter()))
+                    reqOffset += bufsize
+            bufOffset, bufsize, sent = pending.popleft()
+            if depth > 1:
+                try:
+                    resp = self.readresp(True, bufsize + 10, probeTimeout if probing else genTimeout)
+                    rcode, rlen, r = unicmd.resp_parse(resp)
+                    inOrder = rlen == bufsize
+                except (unilink.TransportTimeout, AssertionError):
+                    inOrder = False
+                if not inOrder: # replies can't be matched to the queued offsets, start over from this block one by one
+                    self.log('FDL does not handle queued read requests, falling back to queue depth 1')
+                    self.trace.retry('queued read fallback')
+                    self.drain_input()
+                    depth = 1
+                    probing = False
+                    pending.clear()
+                    reqOffset = offset
+                    continue
+                if not pending: # the whole first window came back, the FDL does queue requests
+                    probing = False
+            else:
+                resp = self.readresp(True, bufsize + 10)
+                rcode, rlen, r = unicmd.resp_parse(resp)
+                assert rlen > 0, 'Could not read partition data at offset 0x%X, response code is %X' % (bufOffset, rcode)
+                if rlen != bufsize: # short reply, continue right after it
+                    reqOffset = bufOffset + rlen
+                    self.trace.retry('short read')
+            self.trace.rtt('read', time.perf_counter() - sent)
+            yield bufOffset, r
+            offset += rlen
+
+    def resume_point(self, outfile, partid, partoffset, partsize):
+        # returns the number of bytes already dumped and the hash state over them, or (0, None) to start over
+        import hashlib
+        try:
+            with open(journal_path(outfile)) as jf:
+                journal = json.load(jf)
+            outf = open(outfile, 'rb')
+        except (OSError, ValueError):
+            self.log('No usable dump journal found, starting from scratch')
+            return 0, None
+        done = journal['done']
+        if journal['partid'] != partid or journal['start'] != partoffset or done > partsize:
+            self.log('Dump journal is for partition 0x%X at offset 0x%X, starting from scratch' % (journal['partid'], journal['start']))
+            outf.close()
+            return 0, None
+        h = hashlib.sha1()
+        left = done
+        while left > 0: # only trust what's both on disk and matches the journal
+            chunk = outf.read(min(left, 0x100000))
+            if not chunk:
+                break
+            h.update(chunk)
+            left -= len(chunk)
+        outf.close()
+        if left > 0 or h.hexdigest() != journal['sha1']:
+            self.log('%s does not match its dump journal, starting from scratch' % outfile)
+            return 0, None
+        self.log('Resuming dump after 0x%X verified bytes (block size was %d)' % (done, journal['blocksize']))
+        return done, h
+
+    @traced('read_partition')
+    def read_partition(self, partid, partsize, partoffset, outfile, rbblocksize, depth = None, resume = False):
+        import hashlib
+        done, h = 0, None
+        if resume:
+            done, h = self.resume_point(outfile, partid, partoffset, partsize)
+        if h is None:
+            h = hashlib.sha1()
+            outf = open(outfile, 'wb')
+        else:
+            outf = open(outfile, 'r+b')
+            outf.truncate(done)
+            outf.seek(done)
+        journal = {'partid': partid, 'start': partoffset, 'length': partsize, 'blocksize': rbblocksize, 'done': done, 'sha1': h.hexdigest()}
+        write_journal(outfile, journal)
+        offset = partoffset + done # end of what's written out
+        self.log('Dumping %d bytes from partition 0x%X at offset 0x%X to %s...' % (partsize, partid, partoffset, outfile))
+        try:
+            for bufOffset, r in self.read_blocks(partid, offset, partoffset + partsize, rbblocksize, depth):
+                outf.write(r)
+                h.update(r)
+                self.progress(len(r))
+                offset += len(r)
+                if offset - partoffset - journal['done'] >= journalInterval:
+                    checkpoint(outf, outfile, journal, offset - partoffset, h)
+        except BaseException:
+            self.log('Dump interrupted at offset 0x%X, run again with --resume to continue' % offset)
+            checkpoint(outf, outfile, journal, offset - partoffset, h)
+            outf.close()
+            raise
+        outf.close()
+        os.remove(journal_path(outfile))
+        self.log('Partition dumped!')
+
+    @traced('read_partition')
+    def read_partition_sparse(self, partid, partsize, partoffset, outfile, rbblocksize, depth = None, codec = 'zlib'):
+        # dump into a sparse container (see unisparse), chunks are compressed on a background thread while reading goes on
+        import unisparse
+        self.log('Dumping %d bytes from partition 0x%X at offset 0x%X to %s (%s container)...' % (partsize, partid, partoffset, outfile, codec))
+        outf = unisparse.SparseWriter(outfile, codec, unisparse.defaultChunkSize, partid, partoffset)
+        offset = partoffset
+        try:
+            for bufOffset, r in self.read_blocks(partid, offset, partoffset + partsize, rbblocksize, depth):
+                outf.write(r)
+                self.progress(len(r))
+                offset += len(r)
+        except BaseException:
+            self.log('Dump interrupted at offset 0x%X' % offset)
+            outf.abort()
+            raise
+        stats = outf.close()
+        self.log('Partition dumped! %d bytes stored in %d (%d of %d chunks erased), SHA-1 %s' % (stats['length'], stats['stored'], stats['erased'], stats['chunks'], stats['sha1']))
+
+    # memory eraser and writer
+
+    @traced('erase_flash_mem', lambda size, faddr: '0x%X+0x%X' % (faddr, size))
+    def erase_flash_mem(self, size, faddr):
+        self.log('Erasing %d bytes in the flash memory at offset 0x%X...' % (size, faddr - UNISOC_FLASH_BASE_ADDR))
+        resp = self.reqresp(unicmd.cmd_erase_flash(faddr, size), True)
+        rcode, rlen, r = unicmd.resp_parse(resp)
+        assert rcode == unicmd.BSL_REP_ACK, 'Could not erase flash memory, response code is %X' % rcode
+        self.log('Flash range erased!')
+
+    def read_sector_size(self):
+        resp = self.reqresp(unicmd.cmd_read_sector_size(), True)
+        rcode, rlen, r = unicmd.resp_parse(resp)
+        if rcode == unicmd.BSL_REP_READ_SECTOR_SIZE and rlen >= 4:
+            return unpack('>L', r[:4])[0]
+        self.log('Could not read the flash sector size (response code is %X), assuming 0x%X' % (rcode, defaultSectorSize))
+        return defaultSectorSize
+
+    @traced('changed_runs')
+    def changed_runs(self, fdata, offset, sectorSize, partid, rbblocksize):
+        # read the flash back and return the ranges of fdata whose sectors differ from it
+        sectors = []
+        for bufOffset, r in self.read_blocks(partid, offset, offset + len(fdata), rbblocksize):
+            pos = bufOffset - offset
+            self.progress(len(r))
+            if r.tobytes() == fdata[pos:pos+len(r)].tobytes():
+                continue
+            for idx in range(bufOffset // sectorSize, (bufOffset + len(r) + sectorSize - 1) // sectorSize):
+                if sectors and sectors[-1] == idx: # a block can share its first sector with the previous one
+                    continue
+                start = max(idx * sectorSize, bufOffset) - bufOffset
+                end = min((idx + 1) * sectorSize, bufOffset + len(r)) - bufOffset
+                if r[start:end].tobytes() != fdata[pos+start:pos+end].tobytes():
+                    sectors.append(idx)
+        return sector_runs(sectors, len(fdata), offset, sectorSize)
+
+    def read_flash_bytes(self, partid, start, end, rbblocksize): # flash contents between two offsets
+        return b''.join(bytes(r) for bufOffset, r in self.read_blocks(partid, start, end, rbblocksize))
+
+    def write_flash_runs(self, fdata, offset, runs, blocksize, partid, sectorSize):
+        # erase and write every run as a separate transfer
+        # erasing takes whole sectors, so the flash contents around a run that doesn't start or end on a sector boundary
+        # are read first and written back together with the image bytes of the edge sectors
+        for start, end in runs: # first and last are the sector bounds around the run, relative to fdata like start and end
+            first = (offset + start) // sectorSize * sectorSize - offset
+            last = -(-(offset + end) // sectorSize) * sectorSize - offset
+            pieces = []
+            if first < start:
+                pieces.append((first, first + sectorSize))
+            middle = (first + sectorSize if first < start else start, last - sectorSize if last > end else end)
+            if middle[0] < middle[1]:
+                pieces.append(middle)
+            if last > end and (not pieces or pieces[-1][1] < last):
+                pieces.append((last - sectorSize, last))
+            edges = [(self.read_flash_bytes(partid, offset + pStart, offset + start, blocksize) if pStart < start else b'',
+                self.read_flash_bytes(partid, offset + end, offset + pEnd, blocksize) if pEnd > end else b'') for pStart, pEnd in pieces]
+            self.erase_flash_mem(last - first, UNISOC_FLASH_BASE_ADDR + offset + first)
+            for (pStart, pEnd), (head, tail) in zip(pieces, edges):
+                data = fdata[max(pStart, start):min(pEnd, end)]
+                if head or tail:
+                    data = head + data.tobytes() + tail
+                self.send_file_to_addr(data, UNISOC_FLASH_BASE_ADDR + offset + pStart, True, True, blocksize)
+
+    @traced('verify_flash')
+    def verify_flash(self, fdata, offset, blocksize, partid, sectorSize = None):
+        # read the written range back, compare it with the image and re-flash the sectors that don't match
+        if sectorSize is None:
+            sectorSize = self.read_sector_size()
+        ranges = [(0, len(fdata))]
+        for attempt in range(verifyRetries + 1):
+            vlen = sum(end - start for start, end in ranges)
+            self.log('Verifying %d bytes...' % vlen)
+            startTime = time.perf_counter()
+            bad = []
+            for start, end in ranges:
+                bad += [(start + s, start + e) for s, e in self.changed_runs(fdata[start:end], offset + start, sectorSize, partid, blocksize)]
+            elapsed = time.perf_counter() - startTime
+            badlen = sum(end - start for start, end in bad)
+            self.log('%d bytes verified in %.2f s (%.2f MB/s), %d bytes mismatching' % (vlen, elapsed, vlen / max(elapsed, 1e-9) / 1e6, badlen))
+            if not bad or attempt == verifyRetries:
+                break
+            self.log('Re-flashing %d mismatching runs...' % len(bad))
+            self.trace.retry('verify re-flash', len(bad))
+            self.write_flash_runs(fdata, offset, bad, blocksize, partid, sectorSize)
+            ranges = bad
+        assert not bad, 'Flash verification failed, %d bytes still mismatching' % badlen
+        self.log('Flash contents verified!')
+
+    def diff_flash_mem(self, infile, offset, blocksize, partid, rbblocksize, fileOffset = 0, length = None, verify = False):
+        # only erase and write the sectors whose contents on the device differ from the image
+        with open_image(infile, fileOffset, length) as src:
+            fdata = src.data
+            sectorSize = self.read_sector_size()
+            self.log('Comparing %d bytes at flash offset 0x%X with %s...' % (len(fdata), offset, infile))
+            runs = self.changed_runs(fdata, offset, sectorSize, partid, rbblocksize)
+            changed = sum(end - start for start, end in runs)
+            self.log('Sector size 0x%X: %d bytes unchanged and skipped, %d bytes to write in %d runs' % (sectorSize, len(fdata) - changed, changed, len(runs)))
+            self.write_flash_runs(fdata, offset, runs, blocksize, partid, sectorSize)
+            if verify:
+                self.verify_flash(fdata, offset, rbblocksize, partid, sectorSize)
+
+    def write_flash_mem(self, infile, offset, blocksize, forceErase, fileOffset = 0, length = None, sparse = False, verify = False, partid = 0x80000003):
+        startAddr = UNISOC_FLASH_BASE_ADDR + offset
+        sectorSize = None
+        with open_image(infile, fileOffset, length) as src:
+            fdata = src.data
+            startTime = time.perf_counter()
+            if sparse: # skip the sectors that are all 0xFF, i.e. already in the erased state
+                sectorSize = self.read_sector_size()
+                runs = dirty_runs(fdata, offset, sectorSize)
+                dirty = sum(end - start for start, end in runs)
+                self.log('Sector size 0x%X: writing %d of %d bytes in %d runs, skipping %d bytes of padding' % (sectorSize, dirty, len(fdata), len(runs), len(fdata) - dirty))
+                self.write_flash_runs(fdata, offset, runs, blocksize, partid, sectorSize)
+            elif forceErase: # the whole image as one run, which keeps the flash around it if it's not sector-aligned
+                sectorSize = self.read_sector_size()
+                self.write_flash_runs(fdata, offset, [(0, len(fdata))], blocksize, partid, sectorSize)
+            else:
+                self.send_file_to_addr(fdata, startAddr, True, True, blocksize)
+            elapsed = time.perf_counter() - startTime
+            self.log('Flash write took %.2f s (%.2f MB/s)' % (elapsed, len(fdata) / max(elapsed, 1e-9) / 1e6))
+            if verify:
+                self.verify_flash(fdata, offset, blocksize, partid, sectorSize)
+
+    # full session: FDL bootstrap and the flash/dump job
+
+    @traced('bootstrap')
+    def bootstrap(self, fdl1, fdl2 = None):
+        # load the FDL(s) through the boot ROM, fdl1 and fdl2 are (label, path, address), fdl2 is None in single FDL mode
+        fdl1Label, fdl1Name, fdl1Addr = fdl1
+        fdl2Label = fdl1Label if fdl2 is None else fdl2[0]
+        self.status = 'bootstrap'
+        self.handshake()
+        self.log('Boot mode entered')
+
+        self.log('Sending ' + fdl1Label)
+        self.send_file_to_addr(fdl1Name, fdl1Addr)
+        self.log('Starting ' + fdl1Label)
+        resp = self.reqresp(unicmd.cmd_data_exec(fdl1Addr))
+        rcode, rlen, r = unicmd.resp_parse(resp)
+        if rcode != unicmd.BSL_REP_ACK:
+            self.log('Could not start %s, response code is %X' % (fdl1Label, rcode))
+            return False
+        self.log(fdl1Label + ' started successfully, reconnecting...')
+        self.reconnect()
+        self.handshake(True)
+
+        if fdl2 is not None:
+            fdl2Label, fdl2Name, fdl2Addr = fdl2
+            self.log('Protocol set up, sending ' + fdl2Label)
+            self.send_file_to_addr(fdl2Name, fdl2Addr, True)
+            self.log('Starting ' + fdl2Label)
+            resp = self.reqresp(unicmd.cmd_data_exec(fdl2Addr), True)
+            rcode, rlen, r = unicmd.resp_parse(resp)
+            if rcode != unicmd.BSL_REP_ACK:
+                self.log('Could not start %s, response code is %X' % (fdl2Label, rcode))
+                return False
+        self.log(fdl2Label + ' started successfully!')
+
+        resp = self.reqresp(unicmd.cmd_sync_full(), True)
+        rcode, rlen, r = unicmd.resp_parse(resp)
+        assert rcode == unicmd.BSL_REP_ACK, 'Could not set the baudrate, response code is %X' % rcode
+
+        self.log(fdl2Label + ' running, may start interacting with flash memory')
+        return True
+
+    def serve(self, args, fdl1, fdl2, outfile):
+        # run the whole flash/dump session described by the command line arguments, returns False if the FDL didn't start
+        self.connect()
+        try:
+            if not self.bootstrap(fdl1, fdl2):
+                return False
+            self.moved = 0
+            readbs = args.block_size
+            if args.mode in ('flash', 'diff-flash'):
+                if args.enable_write_flash:
+                    resp = self.reqresp(unicmd.cmd_enable_write_flash(), True)
+                    rcode, rlen, r = unicmd.resp_parse(resp)
+                    assert rcode == unicmd.BSL_REP_ACK, 'Could not send the flash write request, response code is %X' % rcode
+
+                self.status = 'flashing'
+                self.log('Writing flash at offset 0x%X from %s...' % (args.start, outfile))
+                if args.mode == 'diff-flash': # flashing that reads the device back first
+                    self.diff_flash_mem(outfile, args.start, readbs, args.partid, readbs, args.file_offset, args.length, args.verify)
+                else:
+                    self.write_flash_mem(outfile, args.start, readbs, args.force_erase, args.file_offset, args.length, args.sparse, args.verify, args.partid)
+                self.log('Flash memory written, disconnect the device!')
+            else:
+                readlen = args.length
+                if readlen is None:
+                    readlen = 0x400000
+                if autoBlockSize:
+                    readbs = self.tune_read_block_size(args.partid, args.start, readlen, readbs)
+                self.status = 'dumping'
+                if args.dump_compress is not None:
+                    self.read_partition_sparse(args.partid, readlen, args.start, outfile, readbs, codec=args.dump_compress)
+                else:
+                    self.read_partition(args.partid, readlen, args.start, outfile, readbs, resume=args.resume)
+                resp = self.reqresp(unicmd.cmd_reset(), True)
+                rcode, rlen, r = unicmd.resp_parse(resp)
+                assert rcode == unicmd.BSL_REP_ACK, 'Could not reset the device, response code is %X' % rcode
+            return True
+        finally:
+            self.close()
+            if self.label is None: # station mode has its own table
+                self.report()
+
+# station mode: serve every connected device at once
+
+def station_file(fname, label, isDump): # every device gets its own dump file
+    if not isDump:
+        return fname
+    root, ext = os.path.splitext(fname)
+    return '%s_%s%s' % (root, label, ext)
+
+def station(vid, pid, args, fdl1, fdl2, settleTime):
+    print('Connect the devices %X:%X while holding the bootkey...' % (vid, pid))
+    ports = unilink.find_ports(vid, pid)
+    while not ports:
+        time.sleep(0.1)
+        ports = unilink.find_ports(vid, pid)
+    time.sleep(settleTime) # give the rest of the hub a chance to show up
+    ports = unilink.find_ports(vid, pid)
+    print('Serving %d devices: %s' % (len(ports), ', '.join(unilink.port_label(p) for p in ports)))
+    isDump = args.mode not in ('flash', 'diff-flash')
+    sessions = [UniSession(unilink.UsbTransport(vid, pid, port), unilink.port_label(port)) for port in ports]
+
+    def work(session):
+        session.startTime = time.perf_counter()
+        try:
+            if session.serve(args, fdl1, fdl2, station_file(args.file, session.label, isDump)):
+                session.status = 'done'
+            else:
+                session.status = 'failed: FDL did not start'
+        except Exception as e:
+            session.status = 'failed: %s' % e
+        session.endTime = time.perf_counter()
+
+    workers = [threading.Thread(target=work, args=(s,), daemon=True) for s in sessions]
+    for w in workers:
+        w.start()
+    while any(w.is_alive() for w in workers):
+        for w in workers:
+            w.join(1.0)
+        print('Progress: ' + ', '.join('%s %s %.2f MB' % (s.label, s.status, s.moved / 1e6) for s in sessions))
+
+    print('%-12s %-10s %12s %9s %9s  %s' % ('device', 'mode', 'bytes', 'seconds', 'MB/s', 'status'))
+    totalBytes = 0
+    for s in sessions:
+        elapsed = s.endTime - s.startTime
+        totalBytes += s.moved
+        print('%-12s %-10s %12d %9.2f %9.2f  %s' % (s.label, args.mode, s.moved, elapsed, s.moved / max(elapsed, 1e-9) / 1e6, s.status))
+    wall = max(s.endTime for s in sessions) - min(s.startTime for s in sessions)
+    print('%d devices, %d bytes in %.2f s (%.2f MB/s aggregate)' % (len(sessions), totalBytes, wall, totalBytes / max(wall, 1e-9) / 1e6))
+    if args.trace is not None:
+        unitrace.save_traces(args.trace, {s.label: s.trace for s in sessions})
+    return all(s.status == 'done' for s in sessions)
 
 # main code start
 
@@ -163,17 +951,35 @@ if __name__ == '__main__': # main app start
     from argparse import ArgumentParser
     rootdir = os.path.dirname(os.path.realpath(__file__))
     parser = ArgumentParser(description='UniFlash: an opensource Unisoc/Spreadtrum feature phone flash reader/writer', epilog='(c) Luxferre 2021 --- No rights reserved <https://unlicense.org>')
-    parser.add_argument('mode', help='Operation mode (flash/dump/stone-unpack)')
-    parser.add_argument('file', help='File to read the flash data from or write the dump into, or the stone file to unpack')
+    parser.add_argument('mode', help='Operation mode (flash/diff-flash/dump/stone-unpack/stone-pack/stone-list)')
+    parser.add_argument('file', help='File to read the flash data from or write the dump into, or the stone file to unpack or create')
     parser.add_argument('-p','--partid', type=auto_int, default=0x80000003, help='Partition ID for readback (defaults to 0x80000003 that can address full flash space on SC6531E/F/M)')
     parser.add_argument('-s','--start', type=auto_int, default=0, help='Start position (in the partition when reading or in the flash memory when writing, defaults to 0)')
-    parser.add_argument('-l', '--length', type=auto_int, default=0x400000, help='Data length in bytes to read/write, defaults to 0x400000')
+    parser.add_argument('-l', '--length', type=auto_int, default=None, help='Data length in bytes to read/write, defaults to 0x400000 for reading and to the rest of the file for writing')
+    parser.add_argument('-fo', '--file-offset', type=auto_int, default=0, help='Position in the input file to start flashing from, for writing a part of a larger image (defaults to 0)')
     parser.add_argument('-t','--target', default='sc6531efm_generic', help='Preinstalled target (defaults to sc6531efm_generic, overridable with individual FDL parameters)')
-    parser.add_argument('-d','--directory', default=None, help='Directory where component files will be written to in stone-unpack mode (defaults to the same where the main stone file resides)')
+    parser.add_argument('-d','--directory', default=None, help='Directory where component files will be written to in stone-unpack mode or read from in stone-pack mode (defaults to the same where the main stone file resides)')
+    parser.add_argument('-j','--jobs', type=int, default=1, help='Number of processes (de)compressing LZMA blocks in parallel in stone-unpack/stone-pack mode (defaults to 1)')
+    parser.add_argument('-sc','--stone-cache', nargs='?', const='', default=None, help='Keep decompressed blocks in this directory (defaults to ~/.cache/uniflash/stoned if given without one) and reuse them in stone-unpack mode, unpacked files are copied out of it')
+    parser.add_argument('-scs','--stone-cache-size', type=int, default=512, help='Stone block cache size limit in MB, least recently used entries go first (defaults to 512)')
+    parser.add_argument('-cs','--chunk-size', type=auto_int, default=0x10000, help='Uncompressed size of every LZMA block in stone-pack mode (defaults to 0x10000)')
     parser.add_argument('-nr','--flash-noremap', action='store_true', help='Disable base address remapping for flashing')
     parser.add_argument('-e','--force-erase', action='store_true', help='Erase target flash memory area before flashing')
+    parser.add_argument('-sp','--sparse', action='store_true', help='Only erase and write the flash sectors that hold anything but 0xFF (the skipped ones must already be erased)')
+    parser.add_argument('-v','--verify', action='store_true', help='Read the written range back after flashing and re-flash the sectors that do not match')
     parser.add_argument('-wf','--enable-write-flash', action='store_true', help='Send the write flash enable command before flashing (if necessary and supported)')
     parser.add_argument('-bs','--block-size', type=auto_int, default=4096, help='Readback/write block size (in bytes), defaults to 4096')
+    parser.add_argument('-abs','--auto-block-size', action='store_true', help='Measure a few block sizes on the first part of the transfer and use the fastest one, the result is cached per target')
+    parser.add_argument('-wq','--write-queue', type=int, default=writeQueueDepth, help='Number of data frames to encode ahead while waiting for the device on writes, 0 for lock-step transfer (defaults to %d)' % writeQueueDepth)
+    parser.add_argument('-qd','--queue-depth', type=int, default=readQueueDepth, help='Number of read requests to keep in flight on dumps, falls back to 1 if the FDL cannot handle it (defaults to %d)' % readQueueDepth)
+    parser.add_argument('-dc','--dump-compress', default=None, choices=('zlib', 'lzma'), help='Dump into a sparse container with erased chunks left out and the rest compressed this way (flashing takes such containers as they are)')
+    parser.add_argument('-r','--resume', action='store_true', help='Continue an interrupted dump into the same file from where its journal says it stopped')
+    parser.add_argument('-st','--station', action='store_true', help='Serve every connected device in parallel (dumps get the device location appended to the file name)')
+    parser.add_argument('-sw','--station-wait', type=float, default=5.0, help='Seconds to wait for more devices after the first one shows up in station mode (defaults to 5)')
+    parser.add_argument('-tr','--trace', default=None, help='Save phase timings, request round trip histograms and retry counts of the session as JSON to this file')
+    parser.add_argument('-em','--emulate', default=None, help='Talk to an emulated device that keeps its NOR contents in this file (created erased if missing) instead of USB, for testing and benchmarking')
+    parser.add_argument('-el','--emu-latency', type=float, default=0, help='Reply latency of the emulated device in ms (defaults to 0)')
+    parser.add_argument('-ep','--emu-packet-size', type=auto_int, default=0x8000, help='Largest data packet the emulated FDL accepts (defaults to 0x8000)')
     parser.add_argument('-dv','--device-vid', type=auto_int, default=UNISOC_VID, help='Override device vendor ID')
     parser.add_argument('-dp','--device-pid', type=auto_int, default=UNISOC_PID, help='Override device product ID')
     parser.add_argument('-fdl1','--fdl1-file', default=None, help='Path to FDL1, overrides the target')
@@ -184,36 +990,34 @@ if __name__ == '__main__': # main app start
     parser.add_argument('-saddr','--single-fdl-addr', type=auto_int, default=None, help='Address to load the single FDL into, overrides the target')
 
     args = parser.parse_args()
+    if args.resume and args.dump_compress is not None:
+        parser.error('--resume only works with raw dumps')
 
-    if args.mode.startswith('stone'): # stone-unpack mode
+    if args.mode.startswith('stone'): # stone-unpack/stone-pack/stone-list mode
+        import stoned
         imgfile = args.file
         imgdir = os.path.dirname(os.path.realpath(imgfile))
         if args.directory is not None:
             imgdir = os.path.realpath(args.directory)
 
-        print('Unpacking %s to %s' % (imgfile, imgdir))
-        stoned.unpack_stone(imgfile, imgdir)
-
-    else: # flash/dump mode
-        is_flash = False
-        if args.mode == 'flash':
-            is_flash = True
+        if args.mode == 'stone-list': # header-only index as JSON, see stoned.extract_block() for pulling parts out
+            print(json.dumps(stoned.stone_index(imgfile), indent=1))
+        elif args.mode == 'stone-pack':
+            print('Packing %s into %s' % (imgdir, imgfile))
+            stoned.pack_stone(imgdir, imgfile, args.jobs, args.chunk_size)
+        else:
+            cache = None
+            if args.stone_cache is not None:
+                cache = stoned.BlockCache(args.stone_cache or None, args.stone_cache_size << 20)
+            print('Unpacking %s to %s' % (imgfile, imgdir))
+            stoned.unpack_stone(imgfile, imgdir, args.jobs, cache)
 
+    else: # flash/diff-flash/dump mode
         # parse target and resolve the parameters from it first
-        paramdelim = '_'
-        target = args.target + paramdelim
-        fdlDir = rootdir + '/fdls'
-        fdlList = []
-        for root, dirs, files in os.walk(fdlDir):
-            for name in files:
-                if name.startswith(target):
-                    paramstr = os.path.splitext(name)[0].split(target)[1]
-                    params = paramstr.split(paramdelim)
-                    fdlList.append((params[1], params[0], fdlDir+'/'+name))
-        # resulting fdl list: (tag, address, path)
+        target = args.target + '_'
         fdlSingleName = None
         fdlSingleAddr = None
-        for tag, addr, path in fdlList:
+        for tag, (path, addr) in load_targets(rootdir + '/fdls').get(args.target, {}).items():
             if tag == 'single':
                 fdlSingleName = path
                 fdlSingleAddr = auto_int(addr)
@@ -239,16 +1043,10 @@ if __name__ == '__main__': # main app start
             fdlSingleName = args.single_fdl_file
         if args.single_fdl_addr is not None:
             fdlSingleAddr = args.single_fdl_addr
-        outfile = args.file
-        partitionId = args.partid
-        readbs = args.block_size
-        readoffset = args.start
-        readlen = args.length
-        forceErase = args.force_erase
-        sendEnableWriteFlash = args.enable_write_flash
-        singleFdlMode = False
-        fdl1Label = 'FDL1'
-        fdl2Label = 'FDL2'
+        targetName = args.target
+        autoBlockSize = args.auto_block_size
+        writeQueueDepth = args.write_queue
+        readQueueDepth = max(1, args.queue_depth)
 
         # override flash base addr based on the target
 
@@ -260,72 +1058,33 @@ if __name__ == '__main__': # main app start
             UNISOC_FLASH_BASE_ADDR = 0
 
         if fdlSingleName is not None:
-            singleFdlMode = True
-            fdl1Addr = fdlSingleAddr
-            fdl1Name = fdlSingleName
-            fdl1Label = 'FDL'
-            fdl2Label = 'FDL'
+            fdl1 = ('FDL', fdlSingleName, fdlSingleAddr)
+            fdl2 = None
             print('Using a single FDL %s, loading to 0x%X' % (fdlSingleName, fdlSingleAddr))
         else:
+            fdl1 = ('FDL1', fdl1Name, fdl1Addr)
+            fdl2 = ('FDL2', fdl2Name, fdl2Addr)
             print('Using FDL1 %s, loading to 0x%X' % (fdl1Name, fdl1Addr))
             print('Using FDL2 %s, loading to 0x%X' % (fdl2Name, fdl2Addr))
 
-        # initial connection
-        print('Connect the device %X:%X while holding the bootkey...' % (UNISOC_VID, UNISOC_PID) )
-        dev, epIn, epOut = connect(UNISOC_VID, UNISOC_PID)
-        handshake()
-
-        def reconnect():
-            global dev
-            if dev is not None:
-                usb.util.dispose_resources(dev)
-                time.sleep(0.5)
-            dev, epIn, epOut = connect(UNISOC_VID, UNISOC_PID)
-
-        print('Boot mode entered')
-
-        print('Sending ' + fdl1Label)
-        send_file_to_addr(fdl1Name, fdl1Addr)
-        print('Starting ' + fdl1Label)
-        resp = reqresp(unicmd.cmd_data_exec(fdl1Addr))
-        rcode, rlen, r = unicmd.resp_decode(resp, False)
-        if rcode == unicmd.BSL_REP_ACK:
-            print(fdl1Label + ' started successfully, reconnecting...')
-            reconnect()
-            handshake(True)
-
-            if singleFdlMode:
-                rcode = unicmd.BSL_REP_ACK
+        if args.station:
+            if not station(UNISOC_VID, UNISOC_PID, args, fdl1, fdl2, args.station_wait):
+                sys.exit(1)
+        else:
+            emu = None
+            if args.emulate is not None:
+                import uniemu
+                emu = uniemu.EmulatedDevice(args.emulate, args.emu_latency / 1000, maxPacketSize=args.emu_packet_size, flashBase=UNISOC_FLASH_BASE_ADDR)
+                print('Emulating the device on %s' % args.emulate)
+                session = UniSession(uniemu.EmuTransport(emu))
             else:
-                print('Protocol set up, sending FDL2')
-                send_file_to_addr(fdl2Name, fdl2Addr, True)
-                print('Starting FDL2')
-                resp = reqresp(unicmd.cmd_data_exec(fdl2Addr), True)
-                rcode, rlen, r = unicmd.resp_decode(resp, True)
-            if rcode == unicmd.BSL_REP_ACK:
-                print(fdl2Label + ' started successfully!')
-
-                resp = reqresp(unicmd.cmd_sync_full(), True)
-                rcode, rlen, r = unicmd.resp_decode(resp, True)
-                assert rcode == unicmd.BSL_REP_ACK, 'Could not set the baudrate, response code is %X' % rcode
-
-                print(fdl2Label + ' running, may start interacting with flash memory')
-
-                if is_flash:
-
-                    if sendEnableWriteFlash:
-                        resp = reqresp(unicmd.cmd_enable_write_flash(), True)
-                        rcode, rlen, r = unicmd.resp_decode(resp, True)
-                        assert rcode == unicmd.BSL_REP_ACK, 'Could not send the flash write request, response code is %X' % rcode
-
-                    print('Writing flash at offset 0x%X from %s...' % (readoffset, outfile))
-                    write_flash_mem(outfile, readoffset, readbs, forceErase)
-                    print('Flash memory written, disconnect the device!')
-                else:
-                    read_partition(partitionId, readlen, readoffset, outfile, readbs)
-                    resp = reqresp(unicmd.cmd_reset(), True)
-                    rcode, rlen, r = unicmd.resp_decode(resp, True)
-                    assert rcode == unicmd.BSL_REP_ACK, 'Could not reset the device, response code is %X' % rcode
-
-        if dev is not None: 
-            usb.util.dispose_resources(dev)
+                # initial connection
+                print('Connect the device %X:%X while holding the bootkey...' % (UNISOC_VID, UNISOC_PID) )
+                session = UniSession(unilink.UsbTransport(UNISOC_VID, UNISOC_PID))
+            try:
+                session.serve(args, fdl1, fdl2, args.file)
+            finally:
+                if emu is not None:
+                    emu.close()
+                if args.trace is not None:
+                    unitrace.save_traces(args.trace, {None: session.trace})
@@ -0,0 +1,170 @@
+# Transport layer for UniFlash: moves raw HDLC bytes to and from a device
+# Released into public domain
+
+import sys, time
+
+usb = None # PyUSB is only loaded once a real device is looked for
+
+def load_usb():
+    global usb
+    if usb is None:
+        import usb.core, usb.util
+
+class TransportTimeout(Exception): # the device had nothing to say within the timeout
+    pass
+
+# Every transport provides:
+#   connect(poll=None) - wait for the device and claim it, poll() is called on every unsuccessful attempt
+#   reconnect(poll=None) - connect again after the device re-enumerated (FDL1 started)
+#   close() - release the device
+#   write(data, timeout) - send raw bytes
+#   read(buf, timeout) - fill buf (made by new_buffer) with whatever arrived, return the byte count or raise TransportTimeout
+#   new_buffer(size) - read buffer the transport can fill without copying
+#   packetSize - maximum packet size of the IN endpoint, known after connect
+
+def device_port(dev): # physical location of the device, stays the same when it re-enumerates
+    return (dev.bus, tuple(dev.port_numbers or ()))
+
+def port_label(port):
+    return '%d-%s' % (port[0], '.'.join(str(p) for p in port[1]))
+
+def find_ports(vid, pid):
+    load_usb()
+    return sorted(device_port(d) for d in usb.core.find(find_all=True, idVendor=vid, idProduct=pid))
+
+# device discovery
+
+NETLINK_KOBJECT_UEVENT = 15
+pollMin = 0.005 # first retry delay when looking for the device
+pollMax = 0.1 # the delay doubles up to this, a hotplug event cuts any delay short
+claimRetries = 20 # attempts to claim a device that showed up but isn't accessible yet (e.g. udev is still setting permissions)
+
+class UeventMonitor: # kernel hotplug events from netlink, Linux only
+    def __init__(self):
+        import socket, select
+        self.select = select.select
+        self.sock = socket.socket(socket.AF_NETLINK, socket.SOCK_DGRAM, NETLINK_KOBJECT_UEVENT)
+        self.sock.bind((0, 1)) # kernel uevent multicast group
+        self.sock.setblocking(False)
+
+    def wait(self, timeout): # True if a USB device came or went within the timeout
+        seen = False
+        if self.select([self.sock], [], [], timeout)[0]:
+            while True:
+                try:
+                    msg = self.sock.recv(16384)
+                except BlockingIOError:
+                    break
+                if b'\0SUBSYSTEM=usb\0' in msg and b'\0DEVTYPE=usb_device\0' in msg:
+                    seen = True
+        return seen
+
+    def close(self):
+        self.sock.close()
+
+def open_monitor(): # None where hotplug events aren't available, discovery falls back to polling then
+    if not sys.platform.startswith('linux'):
+        return None
+    try:
+        return UeventMonitor()
+    except OSError:
+        return None
+
+class UsbTransport:
+    def __init__(self, vid, pid, port = None):
+        load_usb()
+        self.vid = vid
+        self.pid = pid
+        self.port = port # only talk to the device at this (bus, port numbers) location if set
+        self.dev = None
+        self.epIn = None
+        self.epOut = None
+        self.packetSize = 512
+        self.monitor = None # hotplug event source, kept open between connect() and close() so no event is missed
+
+    def find(self, skipAddress = None): # skipAddress excludes the device instance that is about to go away
+        def match(d):
+            if self.port is not None and device_port(d) != self.port:
+                return False
+            return skipAddress is None or d.address != skipAddress
+        return usb.core.find(idVendor=self.vid, idProduct=self.pid, custom_match=match)
+
+    def wait_device(self, poll = None, skipAddress = None):
+        # hotplug events wake us up as soon as something changes on the bus, polling with backoff covers the rest
+        if self.monitor is None:
+            self.monitor = open_monitor()
+        delay = pollMin
+        while True:
+            dev = self.find(skipAddress)
+            if dev is not None:
+                return dev
+            if poll is not None:
+                poll()
+            if self.monitor is not None:
+                if self.monitor.wait(delay):
+                    delay = pollMin # something changed, the device may take a few ms more to be visible
+                    continue
+            else:
+                time.sleep(delay)
+            delay = min(delay * 2, pollMax)
+
+    def connect(self, poll = None, skipAddress = None):
+        for attempt in range(claimRetries):
+            dev = self.wait_device(poll, skipAddress)
+            try:
+                self.claim(dev)
+                return
+            except usb.core.USBError:
+                if attempt == claimRetries - 1:
+                    raise
+                usb.util.dispose_resources(dev)
+                time.sleep(pollMin * (attempt + 1))
+
+    def claim(self, dev):
+        dev.set_configuration()
+        cfg = dev.get_active_configuration()
+        intf = cfg[(0,0)]
+        self.packetSize = intf[0].wMaxPacketSize
+        epIn = usb.util.find_descriptor(
+            intf,
+            custom_match = \
+            lambda e: \
+                usb.util.endpoint_direction(e.bEndpointAddress) == \
+                usb.util.ENDPOINT_IN)
+        epOut = usb.util.find_descriptor(
+            intf,
+            custom_match = \
+            lambda e: \
+                usb.util.endpoint_direction(e.bEndpointAddress) == \
+                usb.util.ENDPOINT_OUT)
+        assert epIn is not None
+        assert epOut is not None
+        self.port = device_port(dev)
+        self.dev, self.epIn, self.epOut = dev, epIn, epOut
+
+    def reconnect(self, poll = None):
+        # the device re-enumerates at the same port after FDL1 starts, the old instance is told apart by its bus address
+        oldAddress = self.dev.address
+        usb.util.dispose_resources(self.dev)
+        self.dev = None
+        self.connect(poll, oldAddress)
+
+    def close(self):
+        if self.dev is not None:
+            usb.util.dispose_resources(self.dev)
+            self.dev = None
+        if self.monitor is not None:
+            self.monitor.close()
+            self.monitor = None
+
+    def write(self, data, timeout):
+        self.dev.write(self.epOut, data, timeout)
+
+    def read(self, buf, timeout):
+        try:
+            return self.dev.read(self.epIn, buf, timeout)
+        except usb.core.USBTimeoutError as e:
+            raise TransportTimeout(str(e)) from e
+
+    def new_buffer(self, size):
+        return usb.util.create_buffer(size)
@@ -0,0 +1,299 @@
+#!/usr/bin/env python
+# Sparse compressed dump container for UniFlash: erased chunks take no space, the rest is zlib/LZMA compressed
+# Released into public domain
+
+import os, sys
+import struct
+import zlib
+import threading, queue
+from collections import OrderedDict
+
+# layout: header, chunk data, index (one entry per chunk), footer
+#   header: magic, version, reserved, chunk size, partition id and start offset of the dump
+#   index entry: data offset, stored size, CRC32 of the unpacked chunk, flags
+#   footer: index offset, chunk count, image length, SHA-1 of the whole image, magic again
+# every chunk but the last one holds chunkSize bytes of the image
+
+MAGIC = b'UNISPARS'
+VERSION = 1
+HEADER = struct.Struct('<8sHHLLL')
+ENTRY = struct.Struct('<QLLB3x')
+FOOTER = struct.Struct('<QLQ20s8s')
+
+FLAG_RAW = 0 # stored as is, compression didn't help
+FLAG_ERASED = 1 # all 0xFF, nothing stored
+FLAG_ZLIB = 2
+FLAG_LZMA = 3
+
+codecFlags = {'zlib': FLAG_ZLIB, 'lzma': FLAG_LZMA}
+defaultChunkSize = 0x10000 # NOR sector size on most targets
+writerDepth = 16 # chunks waiting for the compressor thread before write() blocks
+readerCache = 4 # unpacked chunks a SparseImage keeps around
+viewLimit = 0x10000 # SparseView slices up to this long are always unpacked, packet lengths are 16-bit so any data packet fits
+
+def is_container(fname):
+    try:
+        with open(fname, 'rb') as f:
+            return f.read(len(MAGIC)) == MAGIC
+    except OSError:
+        return False
+
+def compress_chunk(chunk, flags, chunkSize):
+    if flags == FLAG_LZMA:
+        import lzma # only needed for LZMA containers
+        # the dictionary doesn't need to be bigger than a chunk, the default one takes far longer to set up
+        filters = [{'id': lzma.FILTER_LZMA2, 'preset': 6, 'dict_size': max(chunkSize, 4096)}]
+        return lzma.compress(chunk, check=lzma.CHECK_NONE, filters=filters)
+    return zlib.compress(chunk)
+
+def decompress_chunk(data, flags):
+    if flags == FLAG_LZMA:
+        import lzma
+        return lzma.decompress(data)
+    if flags == FLAG_ZLIB:
+        return zlib.decompress(data)
+    return data
+
+# writing
+
+class SparseWriter:
+    # writes a container while the image comes in, chunks are compressed and written out on a background thread
+    # (zlib and lzma release the GIL, so this overlaps with the USB read loop)
+    def __init__(self, fname, codec = 'zlib', chunkSize = defaultChunkSize, partid = 0, start = 0):
+        import hashlib
+        assert codec in codecFlags, 'Unknown container codec %s' % codec
+        self.name = fname
+        self.flags = codecFlags[codec]
+        self.chunkSize = chunkSize
+        self.erased = b'\xff' * chunkSize
+        self.f = open(fname, 'wb')
+        self.f.write(HEADER.pack(MAGIC, VERSION, 0, chunkSize, partid, start))
+        self.h = hashlib.sha1()
+        self.length = 0
+        self.pending = bytearray() # start of the next chunk
+        self.index = [] # (offset, stored size, crc, flags) of every chunk written
+        self.error = None
+        self.q = queue.Queue(writerDepth)
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def write(self, data): # data is copied right away, so it may be a view into a buffer that gets reused
+        self.h.update(data)
+        self.length += len(data)
+        self.pending += data
+        while len(self.pending) >= self.chunkSize:
+            self.put(bytes(self.pending[:self.chunkSize]))
+            del self.pending[:self.chunkSize]
+
+    def put(self, chunk):
+        if self.error is not None:
+            raise self.error
+        self.q.put(chunk)
+
+    def run(self):
+        while True:
+            chunk = self.q.get()
+            if chunk is None:
+                return
+            if self.error is None: # after a failure the rest is only drained so that put() never blocks for good
+                try:
+                    self.index.append(self.store(chunk))
+                except BaseException as e:
+                    self.error = e
+
+    def store(self, chunk):
+        crc = zlib.crc32(chunk)
+        if chunk == self.erased[:len(chunk)]:
+            return (0, 0, crc, FLAG_ERASED)
+        flags = self.flags
+        data = compress_chunk(chunk, flags, self.chunkSize)
+        if len(data) >= len(chunk):
+            flags = FLAG_RAW
+            data = chunk
+        offset = self.f.tell()
+        self.f.write(data)
+        return (offset, len(data), crc, flags)
+
+    def finish(self): # wait for the compressor thread to write everything out
+        self.q.put(None)
+        self.thread.join()
+
+    def close(self): # returns the container stats
+        if self.pending:
+            self.put(bytes(self.pending))
+            self.pending = bytearray()
+        self.finish()
+        if self.error is not None:
+            self.f.close()
+            raise self.error
+        indexOffset = self.f.tell()
+        for entry in self.index:
+            self.f.write(ENTRY.pack(*entry))
+        self.f.write(FOOTER.pack(indexOffset, len(self.index), self.length, self.h.digest(), MAGIC))
+        self.f.close()
+        return {'length': self.length, 'stored': os.path.getsize(self.name), 'chunks': len(self.index),
+            'erased': sum(1 for entry in self.index if entry[3] == FLAG_ERASED), 'sha1': self.h.hexdigest()}
+
+    def abort(self): # leave an unfinished container behind, it has no index and is refused by SparseImage
+        self.finish()
+        self.f.close()
+
+# reading
+
+class SparseImage: # random access to the image in a container, chunks are unpacked on demand and checked against their CRC
+    def __init__(self, fname):
+        self.name = fname
+        self.f = open(fname, 'rb')
+        fsize = os.fstat(self.f.fileno()).st_size
+        assert fsize >= HEADER.size + FOOTER.size, '%s is too small for a sparse container' % fname
+        (magic, version, reserved, self.chunkSize, self.partid, self.start) = HEADER.unpack(self.f.read(HEADER.size))
+        assert magic == MAGIC, '%s is not a sparse container' % fname
+        assert version == VERSION, 'Unsupported sparse container version %d in %s' % (version, fname)
+        self.f.seek(fsize - FOOTER.size)
+        (indexOffset, count, self.length, self.sha1, tail) = FOOTER.unpack(self.f.read(FOOTER.size))
+        assert tail == MAGIC, '%s has no index, the dump that made it was probably interrupted' % fname
+        self.f.seek(indexOffset)
+        indexData = self.f.read(count * ENTRY.size)
+        self.index = [ENTRY.unpack_from(indexData, i * ENTRY.size) for i in range(count)]
+        self.cache = OrderedDict() # chunk number -> unpacked chunk, least recently used first
+        self.lock = threading.Lock() # flashing reads from a prefetch thread
+
+    def chunk_length(self, i):
+        return min(self.chunkSize, self.length - i * self.chunkSize)
+
+    def chunk(self, i):
+        data = self.cache.get(i)
+        if data is not None:
+            self.cache.move_to_end(i)
+            return data
+        offset, size, crc, flags = self.index[i]
+        if flags == FLAG_ERASED:
+            data = b'\xff' * self.chunk_length(i)
+        else:
+            self.f.seek(offset)
+            data = decompress_chunk(self.f.read(size), flags)
+            assert len(data) == self.chunk_length(i) and zlib.crc32(data) == crc, 'Chunk %d of %s is corrupted' % (i, self.name)
+        self.cache[i] = data
+        if len(self.cache) > readerCache:
+            self.cache.popitem(last=False)
+        return data
+
+    def read(self, pos, size): # memoryview of the image bytes pos..pos+size, no copy if they're in a single chunk
+        if size <= 0:
+            return memoryview(b'')
+        with self.lock:
+            first = pos // self.chunkSize
+            last = (pos + size - 1) // self.chunkSize
+            if first == last:
+                start = pos - first * self.chunkSize
+                return memoryview(self.chunk(first))[start:start+size]
+            out = bytearray()
+            for i in range(first, last + 1):
+                start = max(pos - i * self.chunkSize, 0)
+                out += self.chunk(i)[start:pos+size-i*self.chunkSize]
+            return memoryview(out)
+
+    def verify(self): # unpack everything and compare with the whole image hash
+        import hashlib
+        h = hashlib.sha1()
+        for i in range(len(self.index)):
+            with self.lock:
+                h.update(self.chunk(i))
+        return h.digest() == self.sha1
+
+    def close(self):
+        self.f.close()
+
+class SparseView: # lazy window into a SparseImage that slices like a memoryview
+    # slices up to a chunk (or viewLimit) long come back as memoryviews of the unpacked data, longer ones stay lazy
+    def __init__(self, image, start, length):
+        self.image = image
+        self.start = start
+        self.length = length
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, key):
+        assert isinstance(key, slice) and key.step in (None, 1), 'Sparse images only support contiguous slices'
+        start, stop, step = key.indices(self.length)
+        size = max(stop - start, 0)
+        if size <= max(self.image.chunkSize, viewLimit):
+            return self.image.read(self.start + start, size)
+        return SparseView(self.image, self.start + start, size)
+
+    def tobytes(self):
+        return self.image.read(self.start, self.length).tobytes()
+
+    def release(self):
+        pass
+
+class SparseSource: # ImageSource for a container: the flash code streams from it without expanding it to disk first
+    def __init__(self, fname, offset = 0, length = None):
+        self.name = fname
+        self.image = SparseImage(fname)
+        if length is None:
+            length = self.image.length - offset
+        assert 0 <= offset and offset + length <= self.image.length, 'Range 0x%X+0x%X is out of bounds of %s (%d bytes)' % (offset, length, fname, self.image.length)
+        self.data = SparseView(self.image, offset, length)
+
+    def __len__(self):
+        return len(self.data)
+
+    def close(self):
+        self.image.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+# main code start
+
+if __name__ == '__main__': # main app start
+    from argparse import ArgumentParser
+    parser = ArgumentParser(description='UniSparse: inspect, verify, create and expand UniFlash sparse dump containers', epilog='No rights reserved <https://unlicense.org>')
+    parser.add_argument('action', help='What to do (info/verify/pack/expand)')
+    parser.add_argument('file', help='Container file (or the raw image to pack)')
+    parser.add_argument('output', nargs='?', default=None, help='Output file of pack/expand (defaults to the input file name with .usp added or removed)')
+    parser.add_argument('-c','--codec', default='zlib', help='Chunk compression when packing: zlib or lzma (defaults to zlib)')
+    parser.add_argument('-cs','--chunk-size', type=lambda x: int(x, 0), default=defaultChunkSize, help='Chunk size when packing (defaults to 0x%X)' % defaultChunkSize)
+
+    args = parser.parse_args()
+
+    if args.action == 'pack':
+        outName = args.output or args.file + '.usp'
+        writer = SparseWriter(outName, args.codec, args.chunk_size)
+        with open(args.file, 'rb') as f:
+            while True:
+                data = f.read(0x100000)
+                if not data:
+                    break
+                writer.write(data)
+        stats = writer.close()
+        print('%s: %d bytes stored in %d (%d of %d chunks erased), SHA-1 %s' % (outName, stats['length'], stats['stored'], stats['erased'], stats['chunks'], stats['sha1']))
+    else:
+        image = SparseImage(args.file)
+        if args.action == 'info':
+            flagCounts = {}
+            for entry in image.index:
+                flagCounts[entry[3]] = flagCounts.get(entry[3], 0) + 1
+            names = {FLAG_RAW: 'raw', FLAG_ERASED: 'erased', FLAG_ZLIB: 'zlib', FLAG_LZMA: 'lzma'}
+            print('Image: %d bytes of partition 0x%X from offset 0x%X, SHA-1 %s' % (image.length, image.partid, image.start, image.sha1.hex()))
+            print('Stored: %d bytes in %d chunks of 0x%X (%s)' % (os.path.getsize(args.file), len(image.index), image.chunkSize, ', '.join('%d %s' % (n, names[f]) for f, n in sorted(flagCounts.items()))))
+        elif args.action == 'verify':
+            if not image.verify():
+                print('%s does not match its SHA-1' % args.file)
+                sys.exit(1)
+            print('%s verified' % args.file)
+        elif args.action == 'expand':
+            outName = args.output or (args.file[:-4] if args.file.endswith('.usp') else args.file + '.bin')
+            with open(outName, 'wb') as outf:
+                for i in range(len(image.index)):
+                    outf.write(image.chunk(i))
+            print('%s: %d bytes written' % (outName, image.length))
+        else:
+            print('Unknown action %s' % args.action)
+            sys.exit(1)
+        image.close()
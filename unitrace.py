@@ -0,0 +1,112 @@
+# Session instrumentation for UniFlash: phase timings, bytes moved, request round trips and retries
+# Released into public domain
+
+import time, json
+from contextlib import contextmanager
+
+class RttHistogram: # request round trip times in power-of-two microsecond buckets
+    def __init__(self):
+        self.buckets = {} # upper bound in us -> count
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = 0.0
+
+    def add(self, seconds):
+        us = max(1, int(seconds * 1e6))
+        bound = 1 << (us - 1).bit_length()
+        self.buckets[bound] = self.buckets.get(bound, 0) + 1
+        self.count += 1
+        self.total += seconds
+        if self.min is None or seconds < self.min:
+            self.min = seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def percentile(self, p): # upper bucket bound in seconds below which p percent of the round trips fall
+        left = self.count * p / 100
+        for bound in sorted(self.buckets):
+            left -= self.buckets[bound]
+            if left <= 0:
+                return min(bound / 1e6, self.max)
+        return self.max
+
+    def to_dict(self):
+        return {
+            'count': self.count,
+            'mean': self.total / self.count if self.count else 0,
+            'min': self.min or 0,
+            'max': self.max,
+            'p50': self.percentile(50),
+            'p99': self.percentile(99),
+            'bucketsUs': {str(b): self.buckets[b] for b in sorted(self.buckets)}
+        }
+
+class Trace:
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.phases = [] # every phase occurrence in start order: name, detail, start offset, seconds, bytes
+        self.open = [] # phases in progress, innermost last
+        self.rtts = {} # request kind -> RttHistogram
+        self.retries = {} # what -> count
+
+    @contextmanager
+    def phase(self, name, detail = None):
+        rec = {'name': name, 'detail': detail, 'start': time.perf_counter() - self.start, 'seconds': None, 'bytes': 0}
+        self.phases.append(rec)
+        self.open.append(rec)
+        try:
+            yield rec
+        finally:
+            self.open.remove(rec)
+            rec['seconds'] = time.perf_counter() - self.start - rec['start']
+
+    def add_bytes(self, nbytes): # counted in every phase in progress
+        for rec in self.open:
+            rec['bytes'] += nbytes
+
+    def rtt(self, kind, seconds):
+        hist = self.rtts.get(kind)
+        if hist is None:
+            hist = self.rtts[kind] = RttHistogram()
+        hist.add(seconds)
+
+    def retry(self, what, count = 1):
+        self.retries[what] = self.retries.get(what, 0) + count
+
+    def to_dict(self):
+        return {
+            'seconds': time.perf_counter() - self.start,
+            'phases': self.phases,
+            'rtt': {kind: hist.to_dict() for kind, hist in self.rtts.items()},
+            'retries': self.retries
+        }
+
+    def summary(self): # table lines: phases aggregated by name in order of first appearance, then round trips and retries
+        totals = {}
+        for rec in self.phases:
+            if rec['seconds'] is None:
+                continue
+            t = totals.setdefault(rec['name'], [0, 0.0, 0])
+            t[0] += 1
+            t[1] += rec['seconds']
+            t[2] += rec['bytes']
+        lines = ['%-20s %5s %9s %12s %9s' % ('phase', 'runs', 'seconds', 'bytes', 'MB/s')]
+        for name, (runs, seconds, nbytes) in totals.items():
+            rate = '%9.2f' % (nbytes / max(seconds, 1e-9) / 1e6) if nbytes else '%9s' % '-'
+            lines.append('%-20s %5d %9.3f %12d %s' % (name, runs, seconds, nbytes, rate))
+        if self.rtts:
+            lines.append('%-20s %8s %9s %9s %9s %9s' % ('round trips', 'count', 'mean ms', 'p50 ms', 'p99 ms', 'max ms'))
+            for kind, hist in self.rtts.items():
+                lines.append('%-20s %8d %9.3f %9.3f %9.3f %9.3f' % (kind, hist.count, hist.total / hist.count * 1e3, hist.percentile(50) * 1e3, hist.percentile(99) * 1e3, hist.max * 1e3))
+        if self.retries:
+            lines.append('retries: ' + ', '.join('%s %d' % (what, count) for what, count in self.retries.items()))
+        return lines
+
+def save_traces(fname, traces): # traces is {label: Trace}, a single unlabelled session is saved as is
+    if list(traces) == [None]:
+        data = traces[None].to_dict()
+    else:
+        data = {label: trace.to_dict() for label, trace in traces.items()}
+    with open(fname, 'w') as tf:
+        json.dump(data, tf, indent=1)